@@ -0,0 +1,89 @@
+import time
+import numpy as np
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+END_TO_END = 'end-to-end'
+HISTOGRAM_EDGES_MS = [0., 0.5, 1., 2., 5., 10., 20., 50., 100., 200., 500., np.inf]
+
+
+class LatencyRing:
+    """ Preallocated ring buffer keeping the last samples of a latency in seconds """
+
+    def __init__(self, capacity):
+        self.samples = np.zeros(capacity)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def values(self):
+        return self.samples[:min(self.count, len(self.samples))]
+
+
+class LatencyTracer:
+    """
+    Measures processing time of pipeline elements and end-to-end latency of buffers with pad probes.
+    A buffer is matched between pads by its PTS, every element writes only to its own ring buffer.
+    """
+
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.rings = {}
+
+    def trace(self, elements):
+        """
+        Adds probes to sink and src pads of the elements.
+        End-to-end latency is measured from the src pad of the first element to the sink pad of the last one.
+        """
+        for element in elements:
+            if element.sinkpads and element.srcpads:
+                arrivals = {}
+                ring = self.rings[element.get_name()] = LatencyRing(self.capacity)
+                for pad in element.sinkpads:
+                    pad.add_probe(Gst.PadProbeType.BUFFER, self.on_arrival, arrivals)
+                for pad in element.srcpads:
+                    pad.add_probe(Gst.PadProbeType.BUFFER, self.on_departure, (arrivals, ring))
+
+        entries = {}
+        ring = self.rings[END_TO_END] = LatencyRing(self.capacity)
+        for pad in elements[0].srcpads:
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.on_arrival, entries)
+        for pad in elements[-1].sinkpads:
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.on_departure, (entries, ring))
+
+    def on_arrival(self, pad, info, arrivals):
+        if len(arrivals) > self.capacity:
+            # buffers dropped inside the element never depart
+            arrivals.clear()
+        arrivals[info.get_buffer().pts] = time.perf_counter()
+        return Gst.PadProbeReturn.OK
+
+    def on_departure(self, pad, info, user_data):
+        arrivals, ring = user_data
+        arrival = arrivals.pop(info.get_buffer().pts, None)
+        if arrival is not None:
+            ring.add(time.perf_counter() - arrival)
+        return Gst.PadProbeReturn.OK
+
+    def write(self, path):
+        """ Writes latency percentiles and histograms of every traced element in milliseconds """
+        with open(path, 'w') as out_file:
+            print("element,buffers,mean,p50,p95,p99,max", file=out_file)
+            histograms = []
+            for name, ring in self.rings.items():
+                values = ring.values() * 1000
+                if len(values) == 0:
+                    continue
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                print("%s,%d,%.3f,%.3f,%.3f,%.3f,%.3f" % (name, ring.count, values.mean(), p50, p95, p99, values.max()),
+                      file=out_file)
+                histograms.append((name, np.histogram(values, HISTOGRAM_EDGES_MS)[0]))
+
+            print("", file=out_file)
+            print("element," + ",".join("<%g" % edge for edge in HISTOGRAM_EDGES_MS[1:]), file=out_file)
+            for name, counts in histograms:
+                print(name + "," + ",".join(str(count) for count in counts), file=out_file)
@@ -0,0 +1,115 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    """ Monotonic value, every series has its own lock so threads updating different series never contend """
+    TYPE = 'counter'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name):
+        return [(name, self.value)]
+
+
+class Gauge(Counter):
+    """ Value that may go up and down """
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Summary:
+    """ Sum and count of observations, e.g. inference time in seconds """
+    TYPE = 'summary'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name):
+        return [(name + '_sum', self.sum), (name + '_count', self.count)]
+
+
+class MetricsRegistry:
+    """
+    Per-stream and per-element metrics exported in Prometheus text format.
+    A series is looked up without locking once created, only creation takes the registry lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.families = {}  # name -> (metric class, help, {labels: series})
+        self.server = None
+
+    def _series(self, metric_class, name, help_text, labels):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        family = self.families.get(name)
+        if family is not None:
+            series = family[2].get(key)
+            if series is not None:
+                return series
+        with self._lock:
+            family = self.families.setdefault(name, (metric_class, help_text, {}))
+            return family[2].setdefault(key, metric_class())
+
+    def counter(self, name, help_text, **labels):
+        return self._series(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, **labels):
+        return self._series(Gauge, name, help_text, labels)
+
+    def summary(self, name, help_text, **labels):
+        return self._series(Summary, name, help_text, labels)
+
+    def render(self):
+        """ Returns all metrics in Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            families = [(name, family[0], family[1], list(family[2].items())) for name, family in self.families.items()]
+        for name, metric_class, help_text, series in families:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_class.TYPE))
+            for key, metric in series:
+                labels = ','.join('%s="%s"' % (label, value.replace('\\', '\\\\').replace('"', '\\"'))
+                                  for label, value in key)
+                for sample_name, value in metric.samples(name):
+                    lines.append('%s{%s} %s' % (sample_name, labels, repr(float(value))) if labels
+                                 else '%s %s' % (sample_name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address='0.0.0.0'):
+        """ Starts the HTTP endpoint serving metrics in a daemon thread """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+        return self.server
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,159 @@
+import numpy as np
+
+
+def cross(origins, ends, points):
+    """ Returns z of the cross product (ends - origins) x (points - origins), arrays broadcast against each other """
+    return ((ends[..., 0] - origins[..., 0]) * (points[..., 1] - origins[..., 1])
+            - (ends[..., 1] - origins[..., 1]) * (points[..., 0] - origins[..., 0]))
+
+
+def segments_cross(starts, ends, gate_starts, gate_ends):
+    """
+    Tests every movement segment (n, 2) against every gate segment (g, 2).
+    Returns the (n, g) direction of proper crossings: 1 when a point moved to the right side of the gate
+    looking from its start to its end in image coordinates, -1 when it moved to the left side
+    and 0 when the segments do not cross.
+    """
+    starts, ends = starts[:, np.newaxis], ends[:, np.newaxis]
+    side_before = cross(gate_starts, gate_ends, starts)
+    side_after = cross(gate_starts, gate_ends, ends)
+    gate_start_side = cross(starts, ends, gate_starts)
+    gate_end_side = cross(starts, ends, gate_ends)
+    crossed = (side_before * side_after < 0) & (gate_start_side * gate_end_side < 0)
+    return np.where(crossed, np.sign(side_after), 0).astype(np.int8)
+
+
+def points_in_polygon(points, polygon):
+    """ Ray casting test of points (n, 2) against the vertices (v, 2) of a polygon, returns (n,) bool """
+    x, y = points[:, 0:1], points[:, 1:2]
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    spans = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = spans & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+    return np.count_nonzero(crossings, axis=1) % 2 == 1
+
+
+class TrackAnalytics(object):
+    """
+    Counts gate crossings and zone occupancy of the tracks of one source.
+    The last point, zone membership and zone entry time of every track live in rows of preallocated arrays,
+    a track takes a row on its first frame and frees it after timeout frames without it,
+    so a frame costs O(active tracks) whatever the history is.
+    """
+
+    def __init__(self, gates, zones, timeout=30, capacity=256):
+        """
+        gates is a dict of name -> ((x1, y1), (x2, y2)) and zones is a dict of name -> [(x, y), ...]
+        """
+        self.gate_names = list(gates)
+        self.gate_starts = np.array([gates[name][0] for name in self.gate_names], dtype=np.float64).reshape(-1, 2)
+        self.gate_ends = np.array([gates[name][1] for name in self.gate_names], dtype=np.float64).reshape(-1, 2)
+        self.zone_names = list(zones)
+        self.zones = [np.array(zones[name], dtype=np.float64) for name in self.zone_names]
+        self.timeout = timeout
+
+        self.crossings = np.zeros((len(self.gate_names), 2), dtype=np.int64)  # to the right side, to the left side
+        self.occupancy = np.zeros(len(self.zone_names), dtype=np.int64)
+
+        self.rows = {}  # track id -> row
+        self.free_rows = []
+        self.used = 0
+        self.track_ids = np.zeros(capacity, dtype=np.uint64)
+        self.points = np.zeros((capacity, 2))
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.seen_at = np.zeros(capacity)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.inside = np.zeros((capacity, len(self.zones)), dtype=bool)
+        self.entered_at = np.zeros((capacity, len(self.zones)))
+
+    def _reserve(self, count):
+        capacity = len(self.track_ids)
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        for name in ('track_ids', 'points', 'last_seen', 'seen_at', 'active', 'inside', 'entered_at'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _get_rows(self, track_ids):
+        """ Returns rows of the tracks and whether each track was seen before, new tracks take free rows """
+        rows = np.empty(len(track_ids), dtype=np.int64)
+        known = np.ones(len(track_ids), dtype=bool)
+        for i, track_id in enumerate(track_ids):
+            row = self.rows.get(track_id)
+            if row is None:
+                if self.free_rows:
+                    row = self.free_rows.pop()
+                else:
+                    self._reserve(self.used + 1)
+                    row = self.used
+                    self.used += 1
+                self.rows[track_id] = row
+                known[i] = False
+            rows[i] = row
+        return rows, known
+
+    def _evict(self, frame):
+        """
+        Frees rows of tracks not seen for timeout frames.
+        Returns ('lost', zone, id, seconds spent in the zone) events of the tracks that were inside zones.
+        """
+        lost = np.flatnonzero(self.active[:self.used] & (self.last_seen[:self.used] < frame - self.timeout))
+        lost_rows, zones = np.nonzero(self.inside[lost])
+        events = [('lost', self.zone_names[zone], int(self.track_ids[row]),
+                   self.seen_at[row] - self.entered_at[row, zone])
+                  for row, zone in zip(lost[lost_rows].tolist(), zones.tolist())]
+        for row in lost.tolist():
+            del self.rows[int(self.track_ids[row])]
+            self.free_rows.append(row)
+        self.active[lost] = False
+        self.inside[lost] = False
+        return events
+
+    def update(self, frame, timestamp, track_ids, points):
+        """
+        Moves the tracks to their points (n, 2) on the frame with the number and timestamp in seconds.
+        Returns events as tuples (kind, name, track id, value): ('cross', gate, id, direction) with
+        direction 1 or -1, ('enter', zone, id, 0.) and ('exit', zone, id, seconds spent in the zone).
+        A track forgotten while inside a zone leaves it with ('lost', zone, id, seconds till it was last seen).
+        """
+        events = []
+        track_ids = [int(track_id) for track_id in track_ids]
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        rows, known = self._get_rows(track_ids)
+
+        if len(self.gate_names) and known.any():
+            directions = segments_cross(self.points[rows[known]], points[known], self.gate_starts, self.gate_ends)
+            np.add.at(self.crossings[:, 0], np.nonzero(directions == 1)[1], 1)
+            np.add.at(self.crossings[:, 1], np.nonzero(directions == -1)[1], 1)
+            known_ids = np.flatnonzero(known)
+            for i, gate in zip(*np.nonzero(directions)):
+                events.append(('cross', self.gate_names[gate], track_ids[known_ids[i]], int(directions[i, gate])))
+
+        if self.zones:
+            inside = np.stack([points_in_polygon(points, zone) for zone in self.zones], axis=1)
+            was_inside = self.inside[rows] & known[:, np.newaxis]
+            entered = inside & ~was_inside
+            exited = was_inside & ~inside
+            for i, zone in zip(*np.nonzero(entered)):
+                events.append(('enter', self.zone_names[zone], track_ids[i], 0.))
+            for i, zone in zip(*np.nonzero(exited)):
+                events.append(('exit', self.zone_names[zone], track_ids[i],
+                               timestamp - self.entered_at[rows[i], zone]))
+            entered_rows, entered_zones = np.nonzero(entered)
+            self.entered_at[rows[entered_rows], entered_zones] = timestamp
+            self.inside[rows] = inside
+
+        self.track_ids[rows] = track_ids
+        self.points[rows] = points
+        self.last_seen[rows] = frame
+        self.seen_at[rows] = timestamp
+        self.active[rows] = True
+        events += self._evict(frame)
+        # tracks missing from the frame stay inside their zones until they exit or are forgotten
+        self.occupancy = self.inside[:self.used][self.active[:self.used]].sum(axis=0)
+        return events
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+
+MAGIC = b'DETREC01'
+# one row per detection, every frame the detector ran on starts with a marker row
+DETECTION_DTYPE = np.dtype([
+    ('source_id', '<u4'),
+    ('frame_num', '<u4'),
+    ('class_id', '<i4'),
+    ('score', '<f4'),
+    ('bbox', '<f4', (4,)),  # x1, y1, x2, y2
+])
+FRAME_MARKER = -1
+
+
+class DetectionRecorder(object):
+    """
+    Appends detections of frames to a binary file of DETECTION_DTYPE rows.
+    A frame marker row keeps frames without detections apart from frames the detector skipped.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+    def write(self, source_id, frame_num, bboxes, class_ids):
+        """ Appends the [x1,y1,x2,y2,score] boxes with their class ids detected on the frame """
+        rows = np.zeros(len(bboxes) + 1, dtype=DETECTION_DTYPE)
+        rows['source_id'] = source_id
+        rows['frame_num'] = frame_num
+        rows['class_id'][0] = FRAME_MARKER
+        rows['class_id'][1:] = class_ids
+        rows['score'][1:] = bboxes[:, 4]
+        rows['bbox'][1:] = bboxes[:, :4]
+        self.file.write(rows.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class DetectionReader(object):
+    """ Memory-maps a detection record and looks up the detections of frames """
+
+    def __init__(self, path):
+        with open(path, 'rb') as record_file:
+            if record_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a detection record" % path)
+        # a row cut by an interrupted recording is left out, the complete rows of its frame are kept
+        count = (os.path.getsize(path) - len(MAGIC)) // DETECTION_DTYPE.itemsize
+        if count > 0:
+            self.rows = np.memmap(path, dtype=DETECTION_DTYPE, mode='r', offset=len(MAGIC), shape=(count,))
+        else:
+            self.rows = np.zeros(0, dtype=DETECTION_DTYPE)
+
+        markers = np.flatnonzero(self.rows['class_id'] == FRAME_MARKER)
+        ends = np.append(markers[1:], len(self.rows))
+        keys = zip(self.rows['source_id'][markers].tolist(), self.rows['frame_num'][markers].tolist())
+        self.frames = dict(zip(keys, zip((markers + 1).tolist(), ends.tolist())))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self, source_id, frame_num):
+        """
+        Returns [x1,y1,x2,y2,score] boxes and class ids of the frame as recorded,
+        None if the detector did not run on the frame.
+        """
+        bounds = self.frames.get((source_id, frame_num))
+        if bounds is None:
+            return None
+        rows = self.rows[bounds[0]:bounds[1]]
+        bboxes = np.empty((len(rows), 5), dtype=np.float32)
+        bboxes[:, :4] = rows['bbox']
+        bboxes[:, 4] = rows['score']
+        return bboxes, np.asarray(rows['class_id'])
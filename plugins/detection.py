@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def batched_nms(boxes, scores, class_ids, iou_threshold, max_detections=0):
+    """
+    Performs class-aware non maximum suppression in one pass over boxes sorted by score.
+    Every class is shifted by its own coordinate offset, so boxes of different classes never overlap.
+    Returns indices of kept boxes in the order of decreasing score, at most max_detections if it is set.
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+    boxes = boxes.astype(np.float64)
+    boxes += (class_ids * (boxes.max() - boxes.min() + 1))[:, np.newaxis]
+    order = np.argsort(-scores, kind='stable')
+    x1, y1, x2, y2 = boxes[order].T
+    areas = (x2 - x1) * (y2 - y1)
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if len(keep) == max_detections:
+            break
+        # suppress the remaining lower-scored boxes overlapping the picked one
+        xx1 = np.maximum(x1[i], x1[i + 1:])
+        yy1 = np.maximum(y1[i], y1[i + 1:])
+        xx2 = np.minimum(x2[i], x2[i + 1:])
+        yy2 = np.minimum(y2[i], y2[i + 1:])
+        inter = np.maximum(0., xx2 - xx1) * np.maximum(0., yy2 - yy1)
+        iou = inter / (areas[i] + areas[i + 1:] - inter)
+        suppressed[i + 1:] |= iou > iou_threshold
+    return order[keep]
+
+
+def filter_detections(bbox_result, threshold, nms, classes=None, class_thresholds=None, max_detections=0):
+    """
+    Turns per-class mmdet results into aligned arrays of boxes [x1,y1,x2,y2,score] and class ids.
+    Classes out of the classes allowlist are skipped before any work is done on them, boxes are
+    thresholded by the confidence of their class and suppressed by class-aware NMS.
+    """
+    bboxes = []
+    class_ids = []
+    for class_id, class_bboxes in enumerate(bbox_result):
+        if classes is not None and class_id not in classes:
+            continue
+        class_threshold = threshold if class_thresholds is None else class_thresholds.get(class_id, threshold)
+        class_bboxes = class_bboxes[class_bboxes[:, -1] > class_threshold]
+        bboxes.append(class_bboxes)
+        class_ids.append(np.full(len(class_bboxes), class_id, dtype=np.int32))
+    if len(bboxes) == 0:
+        return np.empty((0, 5), dtype=np.float32), np.empty(0, dtype=np.int32)
+
+    bboxes = np.vstack(bboxes)
+    class_ids = np.concatenate(class_ids)
+    keep = batched_nms(bboxes[:, :4], bboxes[:, 4], class_ids, nms, max_detections)
+    return bboxes[keep], class_ids[keep]
+
+
+def filter_batch(batch_ids, results, threshold, nms, classes=None, class_thresholds=None, max_detections=0):
+    """ Filters mmdet results of the frames of a batch, returns boxes with their class ids by batch id of the frame """
+    detections = {}
+    for batch_id, result in zip(batch_ids, results):
+        bbox_result = result[0] if isinstance(result, tuple) else result
+        detections[batch_id] = filter_detections(bbox_result, threshold, nms, classes, class_thresholds, max_detections)
+    return detections
@@ -0,0 +1,193 @@
+import os
+import time
+import queue
+import itertools
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from .detection import filter_batch
+from .mmdet_backend import infer, load_detector, warm_up
+from .preprocess import Preprocessor
+from .tiling import detect_tiles, preprocess_tiles
+
+WORKER_READY = -1
+
+
+def detect_shared(model, preprocessor, tile_preprocessor, settings, buf, offset, shape, batch_ids):
+    """ Detects on the frames with the batch ids of a batch stored in the shared buffer """
+    if not batch_ids:
+        return {}
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=buf, offset=offset)
+    frames = [frames[batch_id] for batch_id in batch_ids]
+    if settings['tile_size']:
+        inputs = preprocess_tiles(preprocessor, tile_preprocessor, frames, settings['tile_size'], settings['tile_overlap'],
+                                  settings['tile_full_frame'])
+        return detect_tiles(model, batch_ids, inputs, settings['threshold'], settings['nms'], settings['classes'],
+                            settings['class_thresholds'], settings['max_detections'])
+    img, img_metas = preprocessor(frames)
+    return filter_batch(batch_ids, infer(model, img, img_metas), settings['threshold'], settings['nms'],
+                        settings['classes'], settings['class_thresholds'], settings['max_detections'])
+
+
+def detector_worker(settings, tasks, results, workers):
+    """
+    Runs in a detector process: loads its own model, then detects on batches of frames read
+    from shared memory until it gets None. Every task is answered with (task id, detections, seconds, error).
+    """
+    # the workers share the cores instead of each one taking all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    try:
+        model, cfg = load_detector(settings['config'], settings['checkpoint'], settings['backend'],
+                                   settings['device'], settings['cache_dir'])
+        preprocessor = Preprocessor(cfg, torch.device(settings['device']))
+        tile_preprocessor = Preprocessor(cfg, torch.device(settings['device']), keep_scale=True)
+        warm_up(model, preprocessor, settings['warmup'])
+    except Exception as e:
+        results.put((WORKER_READY, None, 0., repr(e)))
+        return
+    results.put((WORKER_READY, None, 0., None))
+
+    memories = {}  # name -> attached SharedMemory, the ring is replaced when frames grow
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, name, offset, shape, batch_ids = task
+        try:
+            if name not in memories:
+                for memory in memories.values():
+                    memory.close()
+                memories = {name: shared_memory.SharedMemory(name=name)}
+            start = time.perf_counter()
+            detections = detect_shared(model, preprocessor, tile_preprocessor, settings, memories[name].buf, offset, shape, batch_ids)
+            results.put((task_id, detections, time.perf_counter() - start, None))
+        except Exception as e:
+            results.put((task_id, None, 0., repr(e)))
+    for memory in memories.values():
+        memory.close()
+
+
+class DetectorPool(object):
+    """
+    Detector processes fed through a ring of shared memory slots, every slot holds the frames of one buffer.
+    submit copies the frames into a free slot and returns a future of their detections,
+    it blocks while every slot is in flight.
+    """
+
+    def __init__(self, settings, workers, slots, inference_time=None):
+        # CUDA can not be used in forked processes, spawned ones re-import the main module
+        # (run.py), so they still import and initialize GStreamer once on start
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [context.Process(target=detector_worker, args=(settings, self.tasks, self.results, workers),
+                                          name="mmdet-worker-%d" % i, daemon=True) for i in range(workers)]
+        for process in self.processes:
+            process.start()
+        self.inference_time = inference_time
+
+        self.slots = slots
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.slot_size = 0
+        self.memory = None
+        self.task_ids = itertools.count()
+        self.futures = {}  # task id -> (future, slot)
+        self.lock = threading.Lock()
+        self.error = None
+        self.collector = None
+
+        started = 0
+        while started < len(self.processes):
+            try:
+                _, _, _, error = self.results.get(timeout=1.)
+            except queue.Empty:
+                if all(process.is_alive() for process in self.processes):
+                    continue
+                error = "detector worker died"
+            if error is not None:
+                self.close()
+                raise RuntimeError("detector worker failed to start: %s" % error)
+            started += 1
+        self.collector = threading.Thread(target=self.collect, name="mmdet-collector", daemon=True)
+        self.collector.start()
+
+    def allocate(self, slot_size):
+        """ Replaces the ring with slots of slot_size bytes once no slot is in flight """
+        taken = [self.free_slots.get() for _ in range(self.slots - 1)]
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_size * self.slots)
+        self.slot_size = slot_size
+        for slot in taken:
+            self.free_slots.put(slot)
+
+    def submit(self, frames, batch_ids):
+        """ Queues detection on the frames with the batch ids, frames may be unmapped right after the call """
+        slot = self.free_slots.get()
+        if self.error is not None:
+            self.free_slots.put(slot)
+            raise RuntimeError(self.error)
+        if frames.nbytes > self.slot_size:
+            self.allocate(frames.nbytes)
+        offset = slot * self.slot_size
+        np.copyto(np.ndarray(frames.shape, dtype=np.uint8, buffer=self.memory.buf, offset=offset), frames)
+
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            self.futures[task_id] = (future, slot)
+        self.tasks.put((task_id, self.memory.name, offset, frames.shape, batch_ids))
+        return future
+
+    def collect(self):
+        """ Resolves futures with the detections coming back and frees their slots """
+        while True:
+            try:
+                item = self.results.get(timeout=1.)
+            except queue.Empty:
+                if all(process.is_alive() for process in self.processes):
+                    continue
+                self.fail("detector worker died")
+                break
+            if item is None:
+                break
+            task_id, detections, seconds, error = item
+            with self.lock:
+                future, slot = self.futures.pop(task_id)
+            self.free_slots.put(slot)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+                continue
+            if self.inference_time is not None:
+                self.inference_time.observe(seconds)
+            future.set_result(detections)
+
+    def fail(self, message):
+        """ Fails the tasks in flight and every later submit """
+        self.error = message
+        with self.lock:
+            futures, self.futures = self.futures, {}
+        for future, slot in futures.values():
+            self.free_slots.put(slot)
+            future.set_exception(RuntimeError(message))
+
+    def close(self):
+        """ Waits for the tasks in flight and stops the detector processes """
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        if self.collector is not None:
+            self.results.put(None)
+            self.collector.join()
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
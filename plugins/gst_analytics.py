@@ -0,0 +1,240 @@
+import numpy as np
+import sys
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+from gi.repository import Gst, GObject, GstBase
+sys.path.append('../')
+import common.is_aarch_64
+import common.bus_call
+from common.metrics import REGISTRY
+import pyds
+from .analytics import TrackAnalytics
+
+GST_ANALYTICS = 'analytics'
+UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+MAX_LABELS = 16  # MAX_ELEMENTS_IN_DISPLAY_META
+ANCHORS = ('bottom', 'center')
+
+# Standard GStreamer initialization
+GObject.threads_init()
+Gst.init(None)
+
+
+def register(plugin):
+    type_to_register = GObject.type_register(GstAnalytics)
+    return Gst.Element.register(plugin, GST_ANALYTICS, 0, type_to_register)
+
+
+def register_by_name(plugin_name):
+    name = plugin_name
+    description = "Counts gate crossings and zone occupancy of tracks from Deepstream metadata"
+    version = '0.1.0'
+    gst_license = 'LGPL'
+    source_module = 'gstreamer'
+    package = 'analytics'
+    origin = 'MLab'
+    if not Gst.Plugin.register_static(Gst.VERSION_MAJOR, Gst.VERSION_MINOR,
+                                      name, description,
+                                      register, version, gst_license,
+                                      source_module, package, origin):
+        raise ImportError("Plugin {} not registered".format(plugin_name))
+    return True
+
+
+class GstAnalytics(GstBase.BaseTransform):
+    __gstmetadata__ = ("GstAnalytics",
+                       "BaseTransform",
+                       "Count gate crossings and zone occupancy",
+                       "MLab")
+
+    __gsttemplates__ = (Gst.PadTemplate.new("src",
+                                            Gst.PadDirection.SRC,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")),
+                        Gst.PadTemplate.new("sink",
+                                            Gst.PadDirection.SINK,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")))
+
+    __gproperties__ = {
+        "gates": (GObject.TYPE_PYOBJECT,
+                  "gates",
+                  "A property that contains the dict of gate lines by name, a line is ((x1, y1), (x2, y2))",
+                  GObject.ParamFlags.READWRITE
+                  ),
+        "zones": (GObject.TYPE_PYOBJECT,
+                  "zones",
+                  "A property that contains the dict of zone polygons by name, a polygon is [(x, y), ...]",
+                  GObject.ParamFlags.READWRITE
+                  ),
+        "anchor": (GObject.TYPE_PYOBJECT,
+                   "anchor",
+                   "A property that contains the point of a box that is tested: bottom (center of "
+                   "the bottom edge) or center",
+                   GObject.ParamFlags.READWRITE
+                   ),
+        "track-timeout": (GObject.TYPE_PYOBJECT,
+                          "track-timeout",
+                          "A property that contains the number of frames without a track after which it is forgotten",
+                          GObject.ParamFlags.READWRITE
+                          )
+    }
+
+    def __init__(self):
+        self.gates = {}
+        self.zones = {}
+        self.anchor = 'bottom'
+        self.track_timeout = 30
+        self.analytics = {}  # source_id -> TrackAnalytics
+        self.metrics = {}  # source_id -> (crossings counters by gate and direction, occupancy gauges by zone)
+        super(GstAnalytics, self).__init__()
+
+    def do_get_property(self, prop: GObject.GParamSpec):
+        if prop.name == 'gates':
+            return self.gates
+        elif prop.name == 'zones':
+            return self.zones
+        elif prop.name == 'anchor':
+            return self.anchor
+        elif prop.name == 'track-timeout':
+            return self.track_timeout
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop: GObject.GParamSpec, value):
+        if prop.name == 'gates':
+            self.gates = dict(value or {})
+        elif prop.name == 'zones':
+            self.zones = dict(value or {})
+        elif prop.name == 'anchor':
+            if value not in ANCHORS:
+                raise ValueError("anchor must be one of %s" % ', '.join(ANCHORS))
+            self.anchor = value
+        elif prop.name == 'track-timeout':
+            self.track_timeout = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_stop(self):
+        self.analytics.clear()
+        return True
+
+    def get_analytics(self, source_id):
+        """ Returns the analytics of the source, creating it on the first frame of the source """
+        analytics = self.analytics.get(source_id)
+        if analytics is None:
+            analytics = self.analytics[source_id] = TrackAnalytics(self.gates, self.zones, self.track_timeout)
+        return analytics
+
+    def source_metrics(self, source_id):
+        """ Returns the cached crossings counters and occupancy gauges of the source """
+        metrics = self.metrics.get(source_id)
+        if metrics is None:
+            element = self.get_name()
+            crossings = [(REGISTRY.counter('tracking_gate_crossings_total', 'Tracks crossing the gate', element=element,
+                                           source=source_id, gate=gate, direction='right'),
+                          REGISTRY.counter('tracking_gate_crossings_total', 'Tracks crossing the gate', element=element,
+                                           source=source_id, gate=gate, direction='left'))
+                         for gate in self.gates]
+            occupancy = [REGISTRY.gauge('tracking_zone_occupancy', 'Tracks inside the zone', element=element,
+                                        source=source_id, zone=zone)
+                         for zone in self.zones]
+            metrics = self.metrics[source_id] = (crossings, occupancy)
+        return metrics
+
+    def post_events(self, frame_meta, events):
+        """
+        Posts every event as an element message, so the application gets it from the bus.
+        Tracks forgotten inside a zone are posted as exits flagged lost.
+        """
+        for kind, name, track_id, value in events:
+            structure = Gst.Structure.new_empty("analytics-event")
+            structure.set_value("kind", 'exit' if kind == 'lost' else kind)
+            structure.set_value("lost", kind == 'lost')
+            structure.set_value("name", name)
+            structure.set_value("source", frame_meta.source_id)
+            structure.set_value("frame", frame_meta.frame_num)
+            structure.set_value("track", str(track_id))
+            structure.set_value("value", float(value))
+            self.post_message(Gst.Message.new_element(self, structure))
+
+    def add_counts(self, batch_meta, frame_meta, analytics):
+        """ Attaches the counts of the source as display text of the frame """
+        labels = ["%s: %d right %d left" % (gate, right, left)
+                  for gate, (right, left) in zip(analytics.gate_names, analytics.crossings.tolist())]
+        labels += ["%s: %d inside" % (zone, occupancy)
+                   for zone, occupancy in zip(analytics.zone_names, analytics.occupancy.tolist())]
+        labels = labels[:MAX_LABELS]
+        if not labels:
+            return
+
+        display_meta = pyds.nvds_acquire_display_meta_from_pool(batch_meta)
+        display_meta.num_labels = len(labels)
+        for i, label in enumerate(labels):
+            text_params = display_meta.text_params[i]
+            text_params.display_text = label
+            text_params.x_offset = 10
+            text_params.y_offset = 10 + 24 * i
+            text_params.font_params.font_name = "Serif"
+            text_params.font_params.font_size = 12
+            text_params.font_params.font_color.set(1.0, 1.0, 1.0, 1.0)
+            text_params.set_bg_clr = 1
+            text_params.text_bg_clr.set(0.0, 0.0, 0.0, 0.5)
+        pyds.nvds_add_display_meta_to_frame(frame_meta, display_meta)
+
+    def do_transform_ip(self, buf):
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try:
+                frame_meta = pyds.glist_get_nvds_frame_meta(l_frame.data)
+            except StopIteration:
+                break
+
+            track_ids = []
+            boxes = []
+            l_obj = frame_meta.obj_meta_list
+            while l_obj is not None:
+                try:
+                    obj_meta = pyds.glist_get_nvds_object_meta(l_obj.data)
+                except StopIteration:
+                    break
+                if obj_meta.object_id != UNTRACKED_OBJECT_ID:
+                    rect = obj_meta.rect_params
+                    track_ids.append(obj_meta.object_id)
+                    boxes.append((rect.left, rect.top, rect.width, rect.height))
+                try:
+                    l_obj = l_obj.next
+                except StopIteration:
+                    break
+
+            boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+            points = boxes[:, :2] + boxes[:, 2:] * ([0.5, 1.] if self.anchor == 'bottom' else [0.5, 0.5])
+            analytics = self.get_analytics(frame_meta.source_id)
+            events = analytics.update(frame_meta.frame_num, frame_meta.buf_pts / Gst.SECOND, track_ids, points)
+
+            crossings, occupancy = self.source_metrics(frame_meta.source_id)
+            for kind, name, _, value in events:
+                if kind == 'cross':
+                    crossings[analytics.gate_names.index(name)][0 if value > 0 else 1].inc()
+            for gauge, count in zip(occupancy, analytics.occupancy.tolist()):
+                gauge.set(count)
+            self.post_events(frame_meta, events)
+            self.add_counts(batch_meta, frame_meta, analytics)
+            try:
+                l_frame = l_frame.next
+            except StopIteration:
+                break
+        return Gst.FlowReturn.OK
+
+
+register_by_name(GST_ANALYTICS)
@@ -0,0 +1,130 @@
+import sys
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+from gi.repository import Gst, GObject, GstBase
+sys.path.append('../')
+import common.is_aarch_64
+import common.bus_call
+import pyds
+from .det_record import DetectionReader
+
+DET_REPLAY = 'detreplay'
+UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+
+# Standard GStreamer initialization
+GObject.threads_init()
+Gst.init(None)
+
+
+def register(plugin):
+    type_to_register = GObject.type_register(DetReplay)
+    return Gst.Element.register(plugin, DET_REPLAY, 0, type_to_register)
+
+
+def register_by_name(plugin_name):
+    name = plugin_name
+    description = "Writes detections recorded by mmdet to Deepstream metadata"
+    version = '0.1.0'
+    gst_license = 'LGPL'
+    source_module = 'gstreamer'
+    package = 'detreplay'
+    origin = 'MLab'
+    if not Gst.Plugin.register_static(Gst.VERSION_MAJOR, Gst.VERSION_MINOR,
+                                      name, description,
+                                      register, version, gst_license,
+                                      source_module, package, origin):
+        raise ImportError("Plugin {} not registered".format(plugin_name))
+    return True
+
+
+class DetReplay(GstBase.BaseTransform):
+    __gstmetadata__ = ("DetReplay",
+                       "BaseTransform",
+                       "Replay recorded detections",
+                       "MLab")
+
+    __gsttemplates__ = (Gst.PadTemplate.new("src",
+                                            Gst.PadDirection.SRC,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")),
+                        Gst.PadTemplate.new("sink",
+                                            Gst.PadDirection.SINK,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")))
+
+    __gproperties__ = {
+        "record": (GObject.TYPE_PYOBJECT,
+                   "record",
+                   "A property that contains the path to a file with detections recorded by mmdet",
+                   GObject.ParamFlags.READWRITE
+                   )
+    }
+
+    def __init__(self):
+        self.record = None
+        self.reader = None
+        super(DetReplay, self).__init__()
+
+    def do_get_property(self, prop: GObject.GParamSpec):
+        if prop.name == 'record':
+            return self.record
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop: GObject.GParamSpec, value):
+        if prop.name == 'record':
+            self.record = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_start(self):
+        self.reader = DetectionReader(self.record)
+        return True
+
+    def do_stop(self):
+        self.reader = None
+        return True
+
+    def do_transform_ip(self, buf):
+        # frames are never mapped, only metadata is written
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try:
+                frame_meta = pyds.glist_get_nvds_frame_meta(l_frame.data)
+            except StopIteration:
+                break
+
+            # frames skipped by the detector at recording keep bInferDone unset, so the tracker predicts them
+            detections = self.reader.get(frame_meta.source_id, frame_meta.frame_num)
+            if detections is not None:
+                bboxes, class_ids = detections
+                frame_meta.bInferDone = True
+                for class_id, bbox in zip(class_ids.tolist(), bboxes.tolist()):
+                    obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
+                    obj_meta.class_id = class_id
+                    obj_meta.object_id = UNTRACKED_OBJECT_ID
+                    obj_meta.confidence = bbox[-1]
+                    obj_meta.rect_params.left = bbox[0]
+                    obj_meta.rect_params.top = bbox[1]
+                    obj_meta.rect_params.width = bbox[2] - bbox[0]
+                    obj_meta.rect_params.height = bbox[3] - bbox[1]
+                    obj_meta.rect_params.border_width = 2
+                    pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
+            try:
+                l_frame = l_frame.next
+            except StopIteration:
+                break
+        return Gst.FlowReturn.OK
+
+
+register_by_name(DET_REPLAY)
@@ -1,19 +1,33 @@
 import numpy as np
 import gi
 import sys
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstBase', '1.0')
 sys.path.append('../')
 import common.is_aarch_64
 import common.bus_call
-from gi.repository import Gst, GObject, GstBase
+from common.metrics import REGISTRY
+from gi.repository import Gst, GObject, GstBase, GLib
 from .gst_hacks import get_buffer_size, map_gst_buffer
-from mmdet.apis import init_detector, inference_detector
+import torch
+from .mmdet_backend import DEFAULT_CACHE_DIR, infer, load_detector, warm_up
+from .detector_pool import DetectorPool
+from .tiling import detect_tiles, preprocess_tiles
+from .motion import MotionGate
+from .preprocess import Preprocessor
+from .detection import filter_batch
+from .det_record import DetectionRecorder
 import pyds
 
 MMDET = 'mmdet'
 UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+# GST_BASE_TRANSFORM_FLOW_DROPPED, the buffer is not pushed by the base class
+BASE_TRANSFORM_FLOW_DROPPED = Gst.FlowReturn.CUSTOM_SUCCESS
 # Standard GStreamer initialization
 GObject.threads_init()
 Gst.init(None)
@@ -40,53 +54,6 @@ def register_by_name(plugin_name):
     return True
 
 
-def non_max_suppression_fast(boxes, overlapThresh):
-    # if there are no boxes, return an empty list
-    if len(boxes) == 0:
-        return []
-    # if the bounding boxes integers, convert them to floats --
-    # this is important since we'll be doing a bunch of divisions
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
-    # initialize the list of picked indexes
-    pick = []
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    # compute the area of the bounding boxes and sort the bounding
-    # boxes by the bottom-right y-coordinate of the bounding box
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(y2)
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
-        # find the largest (x, y) coordinates for the start of
-        # the bounding box and the smallest (x, y) coordinates
-        # for the end of the bounding box
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[:last]]
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-                                               np.where(overlap > overlapThresh)[0])))
-    # return only the bounding boxes that were picked using the
-    # integer data type
-    return boxes[pick]
-
-
 class MMDet(GstBase.BaseTransform):
     CHANNELS = 4  # RGBA
 
@@ -132,7 +99,101 @@ class MMDet(GstBase.BaseTransform):
                       "nms",
                       "A property that contains the nms threshold",
                       GObject.ParamFlags.READWRITE
-                      )
+                      ),
+        "classes": (GObject.TYPE_PYOBJECT,
+                    "classes",
+                    "A property that contains the list of class ids to detect, None to detect all classes",
+                    GObject.ParamFlags.READWRITE
+                    ),
+        "class-thresholds": (GObject.TYPE_PYOBJECT,
+                             "class-thresholds",
+                             "A property that contains the dict of confidence thresholds by class id",
+                             GObject.ParamFlags.READWRITE
+                             ),
+        "max-detections": (GObject.TYPE_PYOBJECT,
+                           "max-detections",
+                           "A property that contains the maximum number of detections per frame, 0 for no limit",
+                           GObject.ParamFlags.READWRITE
+                           ),
+        "async-depth": (GObject.TYPE_PYOBJECT,
+                        "async-depth",
+                        "A property that contains the number of buffers in flight in a worker thread, "
+                        "0 runs inference on the streaming thread",
+                        GObject.ParamFlags.READWRITE
+                        ),
+        "interval": (GObject.TYPE_PYOBJECT,
+                     "interval",
+                     "A property that contains the number of buffers per inference, "
+                     "the other buffers are passed through without detections",
+                     GObject.ParamFlags.READWRITE
+                     ),
+        "record": (GObject.TYPE_PYOBJECT,
+                   "record",
+                   "A property that contains the path to a file the detections are recorded to, None to disable",
+                   GObject.ParamFlags.READWRITE
+                   ),
+        "warmup": (GObject.TYPE_PYOBJECT,
+                   "warmup",
+                   "A property that contains the number of inferences on a blank frame run at start",
+                   GObject.ParamFlags.READWRITE
+                   ),
+        "device": (GObject.TYPE_PYOBJECT,
+                   "device",
+                   "A property that contains the torch device to run inference on, e.g. cuda:0 or cpu",
+                   GObject.ParamFlags.READWRITE
+                   ),
+        "backend": (GObject.TYPE_PYOBJECT,
+                    "backend",
+                    "A property that contains the inference backend: pytorch or onnxruntime",
+                    GObject.ParamFlags.READWRITE
+                    ),
+        "cache-dir": (GObject.TYPE_PYOBJECT,
+                      "cache-dir",
+                      "A property that contains the directory with models exported for the onnxruntime backend",
+                      GObject.ParamFlags.READWRITE
+                      ),
+        "workers": (GObject.TYPE_PYOBJECT,
+                    "workers",
+                    "A property that contains the number of detector processes with their own models, "
+                    "0 runs inference in this process",
+                    GObject.ParamFlags.READWRITE
+                    ),
+        "tile-size": (GObject.TYPE_PYOBJECT,
+                      "tile-size",
+                      "A property that contains the side of square tiles frames are split into for detection, "
+                      "0 detects on whole frames. Tiles are detected at their native resolution, so a frame costs "
+                      "about as much as its full-resolution pass, set it near the network input scale",
+                      GObject.ParamFlags.READWRITE
+                      ),
+        "tile-overlap": (GObject.TYPE_PYOBJECT,
+                         "tile-overlap",
+                         "A property that contains the number of pixels neighbouring tiles overlap by",
+                         GObject.ParamFlags.READWRITE
+                         ),
+        "tile-full-frame": (GObject.TYPE_PYOBJECT,
+                            "tile-full-frame",
+                            "A property that contains whether whole frames are detected on besides the tiles, "
+                            "so objects larger than a tile are found",
+                            GObject.ParamFlags.READWRITE
+                            ),
+        "motion-threshold": (GObject.TYPE_PYOBJECT,
+                             "motion-threshold",
+                             "A property that contains the ratio of pixels changed since the last detected frame "
+                             "of the source below which detection is skipped, 0 detects on every frame",
+                             GObject.ParamFlags.READWRITE
+                             ),
+        "motion-max-skipped": (GObject.TYPE_PYOBJECT,
+                               "motion-max-skipped",
+                               "A property that contains the number of frames of a source skipped by the motion gate "
+                               "after which the next frame is detected anyway",
+                               GObject.ParamFlags.READWRITE
+                               ),
+        "motion-reuse": (GObject.TYPE_PYOBJECT,
+                         "motion-reuse",
+                         "A property that contains whether frames skipped by the motion gate get the last detections "
+                         "of their source, otherwise the tracker predicts them",
+                         GObject.ParamFlags.READWRITE
+                         )
     }
 
     def __init__(self):
@@ -140,7 +201,40 @@ class MMDet(GstBase.BaseTransform):
         self.checkpoint = None
         self.threshold = 0.5
         self.nms = 0.5
+        self.classes = None
+        self.class_thresholds = None
+        self.max_detections = 0
+        self.async_depth = 0
+        self.interval = 1
+        self.record = None
+        self.recorder = None
+        self.warmup = 0
+        self.device = 'cuda:0'
+        self.backend = 'pytorch'
+        self.cache_dir = DEFAULT_CACHE_DIR
+        self.cfg = None
+        self.workers = 0
+        self.pool = None
+        self.tile_size = 0
+        self.tile_overlap = 64
+        self.tile_full_frame = True
+        self.motion_threshold = 0
+        self.motion_max_skipped = 30
+        self.motion_reuse = True
+        self.motion_gate = None
+        self.last_detections = {}  # source_id -> detections of the last detected frame
+        self.buffer_count = 0
         self.model = None
+        self.preprocessor = None
+        self.tile_preprocessor = None
+        self.metrics = {}  # source_id -> (frames counter, detections counter)
+        self.inference_time = None
+
+        # async mode: buffers with their inference futures in the order they came in
+        self.pending = None
+        self.executor = None
+        self.pusher = None
+        self.flow_return = Gst.FlowReturn.OK
 
         super(MMDet, self).__init__()
 
@@ -153,57 +247,244 @@ class MMDet(GstBase.BaseTransform):
             return self.threshold
         elif prop.name == 'nms':
             return self.nms
+        elif prop.name == 'classes':
+            return self.classes
+        elif prop.name == 'class-thresholds':
+            return self.class_thresholds
+        elif prop.name == 'max-detections':
+            return self.max_detections
+        elif prop.name == 'async-depth':
+            return self.async_depth
+        elif prop.name == 'interval':
+            return self.interval
+        elif prop.name == 'record':
+            return self.record
+        elif prop.name == 'warmup':
+            return self.warmup
+        elif prop.name == 'device':
+            return self.device
+        elif prop.name == 'backend':
+            return self.backend
+        elif prop.name == 'cache-dir':
+            return self.cache_dir
+        elif prop.name == 'workers':
+            return self.workers
+        elif prop.name == 'tile-size':
+            return self.tile_size
+        elif prop.name == 'tile-overlap':
+            return self.tile_overlap
+        elif prop.name == 'tile-full-frame':
+            return self.tile_full_frame
+        elif prop.name == 'motion-threshold':
+            return self.motion_threshold
+        elif prop.name == 'motion-max-skipped':
+            return self.motion_max_skipped
+        elif prop.name == 'motion-reuse':
+            return self.motion_reuse
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
     def do_set_property(self, prop: GObject.GParamSpec, value):
         if prop.name == 'config':
             self.config = value
-            if self.checkpoint is not None and self.model is None:
-                self.model = init_detector(self.config, self.checkpoint, device='cuda:0')
+            self.model = None  # built on start
         elif prop.name == 'checkpoint':
             self.checkpoint = value
-            if self.checkpoint is not None and self.model is None:
-                self.model = init_detector(self.config, self.checkpoint, device='cuda:0')
+            self.model = None
         elif prop.name == 'threshold':
             self.threshold = value
         elif prop.name == 'nms':
             self.nms = value
+        elif prop.name == 'classes':
+            self.classes = None if value is None else set(value)
+        elif prop.name == 'class-thresholds':
+            self.class_thresholds = value
+        elif prop.name == 'max-detections':
+            self.max_detections = value
+        elif prop.name == 'async-depth':
+            self.async_depth = value
+        elif prop.name == 'interval':
+            self.interval = value
+        elif prop.name == 'record':
+            self.record = value
+        elif prop.name == 'warmup':
+            self.warmup = value
+        elif prop.name == 'device':
+            self.device = value
+            self.model = None
+        elif prop.name == 'backend':
+            self.backend = value
+            self.model = None
+        elif prop.name == 'cache-dir':
+            self.cache_dir = value
+        elif prop.name == 'workers':
+            self.workers = value
+        elif prop.name == 'tile-size':
+            self.tile_size = value
+        elif prop.name == 'tile-overlap':
+            self.tile_overlap = value
+        elif prop.name == 'tile-full-frame':
+            self.tile_full_frame = value
+        elif prop.name == 'motion-threshold':
+            self.motion_threshold = value
+        elif prop.name == 'motion-max-skipped':
+            self.motion_max_skipped = value
+        elif prop.name == 'motion-reuse':
+            self.motion_reuse = value
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
-    def do_transform_ip(self, buf):
-        success, (width, height) = get_buffer_size(self.srcpad.get_current_caps())
-        if not success:
-            return Gst.FlowReturn.ERROR
+    def do_start(self):
+        self.inference_time = REGISTRY.summary('tracking_inference_seconds', 'Time spent in detector inference',
+                                               element=self.get_name())
+        if self.record is not None:
+            self.recorder = DetectionRecorder(self.record)
+        if self.motion_threshold:
+            self.motion_gate = MotionGate(self.motion_threshold, self.motion_max_skipped)
+        self.last_detections.clear()
+        if self.workers > 0:
+            # every worker process holds one batch while the next one is copied into its slot
+            self.pool = DetectorPool(self.get_settings(), self.workers, 2 * self.workers, self.inference_time)
+            depth = 2 * self.workers
+        else:
+            if self.model is None:
+                self.model, self.cfg = load_detector(self.config, self.checkpoint, self.backend, self.device,
+                                                     self.cache_dir)
+            # a batch may be preprocessed while async-depth batches are queued and one more is held by
+            # the pusher, on CPU the model reads the slot memory itself
+            slots = self.async_depth + 2
+            self.preprocessor = Preprocessor(self.cfg, torch.device(self.device), slots=slots)
+            self.tile_preprocessor = Preprocessor(self.cfg, torch.device(self.device), slots=slots, keep_scale=True)
+            warm_up(self.model, self.preprocessor, self.warmup)
+            depth = self.async_depth
+        if depth > 0:
+            self.flow_return = Gst.FlowReturn.OK
+            self.pending = queue.Queue(maxsize=depth)
+            if self.pool is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.pusher = threading.Thread(target=self.push_results, name="mmdet-pusher", daemon=True)
+            self.pusher.start()
+        return True
 
-        with map_gst_buffer(buf, Gst.MapFlags.READ) as mapped:
-            frame = np.ndarray((height, width, self.CHANNELS), buffer=mapped, dtype=np.uint8)
+    def get_settings(self):
+        """ Returns what a detector process needs to load the model and filter detections like this element """
+        return dict(config=self.config, checkpoint=self.checkpoint, backend=self.backend, device=self.device,
+                    cache_dir=self.cache_dir, warmup=self.warmup, threshold=self.threshold, nms=self.nms,
+                    classes=self.classes, class_thresholds=self.class_thresholds, max_detections=self.max_detections,
+                    tile_size=self.tile_size, tile_overlap=self.tile_overlap, tile_full_frame=self.tile_full_frame)
 
-        result = inference_detector(self.model, frame[..., :3])
+    def do_stop(self):
+        if self.pusher is not None:
+            self.pending.put(None)
+            self.pusher.join()
+            self.pending = self.pusher = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        self.motion_gate = None
+        return True
 
-        if isinstance(result, tuple):
-            bbox_result, segm_result = result
-        else:
-            bbox_result, segm_result = result, None
+    def do_sink_event(self, event):
+        if self.pending is not None:
+            # serialized events (caps, segment, EOS...) must not overtake buffers in flight
+            if Gst.event_type_get_flags(event.type) & Gst.EventTypeFlags.SERIALIZED:
+                self.pending.join()
+            if event.type == Gst.EventType.FLUSH_STOP:
+                self.flow_return = Gst.FlowReturn.OK
+        return GstBase.BaseTransform.do_sink_event(self, event)
 
-        # get class ids and detections as ndarrays
-        class_ids = [
-            np.full(bbox.shape[0], i, dtype=np.int32)
-            for i, bbox in enumerate(bbox_result)
-        ]
-        class_ids = np.concatenate(class_ids)
-        bboxes = np.vstack(bbox_result)
+    def detect(self, batch_ids, inputs):
+        """
+        Runs the detector once on the preprocessed frames of the batch, or on their tiles in the tiling mode.
+        Returns the filtered boxes with their class ids by batch id of the frame.
+        """
+        if len(batch_ids) == 0:
+            return {}
+        start = time.perf_counter()
+        if self.tile_size:
+            detections = detect_tiles(self.model, batch_ids, inputs, self.threshold, self.nms, self.classes,
+                                      self.class_thresholds, self.max_detections)
+            self.inference_time.observe(time.perf_counter() - start)
+            return detections
+        img, img_metas = inputs
+        results = infer(self.model, img, img_metas)
+        self.inference_time.observe(time.perf_counter() - start)
 
-        # do thresholding by confidence
-        scores = bboxes[:, -1]
-        inds = scores > self.threshold
-        bboxes = bboxes[inds, :]
-        class_ids = class_ids[inds]
+        return filter_batch(batch_ids, results, self.threshold, self.nms, self.classes, self.class_thresholds,
+                            self.max_detections)
 
-        # nms
-        bboxes = non_max_suppression_fast(bboxes, self.nms)
+    @staticmethod
+    def get_batch_sources(buf):
+        """ Returns source ids of the frames in the buffer by their batch ids """
+        sources = {}
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try:
+                frame_meta = pyds.glist_get_nvds_frame_meta(l_frame.data)
+            except StopIteration:
+                break
+            sources[frame_meta.batch_id] = frame_meta.source_id
+            try:
+                l_frame = l_frame.next
+            except StopIteration:
+                break
+        return sources
+
+    def get_frames(self, mapped, width, height):
+        """ Splits the mapped buffer into the (batch, height, width, channels) array of its frames """
+        frame_size = height * width * self.CHANNELS
+        return np.ndarray((len(mapped) // frame_size, height, width, self.CHANNELS), buffer=mapped, dtype=np.uint8)
+
+    def gate_motion(self, mapped, width, height, sources):
+        """
+        Splits the frames of the mapped buffer into the ones to detect on and the ones
+        that get the last detections of their source because nothing moved in them.
+        """
+        if self.motion_gate is None:
+            return list(sources), []
+        frames = self.get_frames(mapped, width, height)
+        batch_ids = []
+        reused = []
+        for batch_id, source_id in sources.items():
+            if self.motion_gate(source_id, frames[batch_id]):
+                batch_ids.append(batch_id)
+            elif self.motion_reuse:
+                reused.append(batch_id)
+        return batch_ids, reused
 
+    def preprocess(self, mapped, width, height, batch_ids):
+        """ Turns the frames of the mapped buffer into network input, nothing refers to the buffer afterwards """
+        if len(batch_ids) == 0:
+            return None
+        frames = self.get_frames(mapped, width, height)
+        frames = [frames[batch_id] for batch_id in batch_ids]
+        if self.tile_size:
+            return preprocess_tiles(self.preprocessor, self.tile_preprocessor, frames, self.tile_size,
+                                    self.tile_overlap, self.tile_full_frame)
+        return self.preprocessor(frames)
+
+    def source_metrics(self, source_id):
+        """ Returns the cached frames and detections counters of the source """
+        metrics = self.metrics.get(source_id)
+        if metrics is None:
+            element = self.get_name()
+            metrics = self.metrics[source_id] = (
+                REGISTRY.counter('tracking_frames_total', 'Frames processed', element=element, source=source_id),
+                REGISTRY.counter('tracking_detections_total', 'Objects detected', element=element, source=source_id))
+        return metrics
+
+    def attach_meta(self, buf, detections, reused=()):
+        """
+        Adds the detections to the frames of the buffer with matching batch ids as untracked objects.
+        Frames with reused batch ids get the last detections of their source.
+        """
         batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
         l_frame = batch_meta.frame_meta_list
         while l_frame is not None:
@@ -212,22 +493,97 @@ class MMDet(GstBase.BaseTransform):
             except StopIteration:
                 break
 
-            for class_id, bbox in zip(class_ids, bboxes):
-                obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
-                obj_meta.class_id = class_id
-                obj_meta.object_id = UNTRACKED_OBJECT_ID
-                obj_meta.confidence = bbox[-1]
-                obj_meta.rect_params.left = bbox[0]
-                obj_meta.rect_params.top = bbox[1]
-                obj_meta.rect_params.width = bbox[2] - bbox[0]
-                obj_meta.rect_params.height = bbox[3] - bbox[1]
-                obj_meta.rect_params.border_width = 2
-                pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
+            frame_detections = detections.get(frame_meta.batch_id)
+            if frame_detections is not None:
+                self.last_detections[frame_meta.source_id] = frame_detections
+            elif frame_meta.batch_id in reused:
+                frame_detections = self.last_detections.get(frame_meta.source_id)
+            if frame_detections is not None:
+                bboxes, class_ids = frame_detections
+                frame_meta.bInferDone = True
+                frames_metric, detections_metric = self.source_metrics(frame_meta.source_id)
+                frames_metric.inc()
+                detections_metric.inc(len(bboxes))
+                if self.recorder is not None:
+                    self.recorder.write(frame_meta.source_id, frame_meta.frame_num, bboxes, class_ids)
+                for class_id, bbox in zip(class_ids, bboxes):
+                    obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
+                    obj_meta.class_id = class_id
+                    obj_meta.object_id = UNTRACKED_OBJECT_ID
+                    obj_meta.confidence = bbox[-1]
+                    obj_meta.rect_params.left = bbox[0]
+                    obj_meta.rect_params.top = bbox[1]
+                    obj_meta.rect_params.width = bbox[2] - bbox[0]
+                    obj_meta.rect_params.height = bbox[3] - bbox[1]
+                    obj_meta.rect_params.border_width = 2
+                    pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
             try:
                 l_frame = l_frame.next
             except StopIteration:
                 break
 
+    def push_results(self):
+        """ Waits for inference of buffers in flight, attaches the detections and pushes them in order """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                break
+            buf, future, reused = item
+            try:
+                if future is not None or reused:
+                    self.attach_meta(buf, future.result() if future is not None else {}, reused)
+                flow_return = self.srcpad.push(buf)
+            except Exception as e:
+                error = GLib.Error.new_literal(Gst.StreamError.quark(), str(e), Gst.StreamError.FAILED)
+                self.post_message(Gst.Message.new_error(self, error, "inference failed"))
+                flow_return = Gst.FlowReturn.ERROR
+            if flow_return != Gst.FlowReturn.OK:
+                # reported upstream on the next buffer
+                self.flow_return = flow_return
+            self.pending.task_done()
+
+    def do_transform_ip(self, buf):
+        success, (width, height) = get_buffer_size(self.srcpad.get_current_caps())
+        if not success:
+            return Gst.FlowReturn.ERROR
+
+        # frames skipped by the interval keep bInferDone unset, so the tracker predicts them
+        skip = self.buffer_count % self.interval != 0
+        self.buffer_count += 1
+
+        if self.pending is not None:
+            if self.flow_return != Gst.FlowReturn.OK:
+                return self.flow_return
+            if skip:
+                # still goes through the queue to keep the order of buffers
+                self.pending.put((buf, None, ()))
+                return BASE_TRANSFORM_FLOW_DROPPED
+            sources = self.get_batch_sources(buf)
+            future = None
+            with map_gst_buffer(buf, Gst.MapFlags.READ) as mapped:
+                batch_ids, reused = self.gate_motion(mapped, width, height, sources)
+                if batch_ids and self.pool is not None:
+                    # frames are copied to shared memory, blocks while every slot is in flight
+                    future = self.pool.submit(self.get_frames(mapped, width, height), batch_ids)
+                elif batch_ids:
+                    inputs = self.preprocess(mapped, width, height, batch_ids)
+            if batch_ids and self.pool is None:
+                future = self.executor.submit(self.detect, batch_ids, inputs)
+            # blocks when async-depth buffers are already in flight
+            self.pending.put((buf, future, reused))
+            return BASE_TRANSFORM_FLOW_DROPPED
+
+        if skip:
+            return Gst.FlowReturn.OK
+
+        sources = self.get_batch_sources(buf)
+        with map_gst_buffer(buf, Gst.MapFlags.READ) as mapped:
+            batch_ids, reused = self.gate_motion(mapped, width, height, sources)
+            inputs = self.preprocess(mapped, width, height, batch_ids)
+        detections = self.detect(batch_ids, inputs)
+
+        self.attach_meta(buf, detections, reused)
         return Gst.FlowReturn.OK
 
 
@@ -1,12 +1,14 @@
 import numpy as np
 import sys
 import gi
+from concurrent.futures import ThreadPoolExecutor
 gi.require_version('Gst', '1.0')
 gi.require_version('GstBase', '1.0')
 from gi.repository import Gst, GObject, GstBase
 sys.path.append('../')
 import common.is_aarch_64
 import common.bus_call
+from common.metrics import REGISTRY
 import pyds
 from .sort import Sort
 
@@ -64,15 +66,129 @@ class GstSORT(GstBase.BaseTransform):
                                                                  "height=[1,2147483647],"
                                                                  "framerate=[0/1,2147483647/1]")))
 
+    __gproperties__ = {
+        "idle-batches": (GObject.TYPE_PYOBJECT,
+                         "idle-batches",
+                         "A property that contains the number of batches without frames from a source "
+                         "after which the tracker of the source is dropped",
+                         GObject.ParamFlags.READWRITE
+                         ),
+        "workers": (GObject.TYPE_PYOBJECT,
+                    "workers",
+                    "A property that contains the number of threads tracking different sources in parallel",
+                    GObject.ParamFlags.READWRITE
+                    )
+    }
+
     def __init__(self):
-        self.sort = Sort()
-        self.tracks = []
+        self.trackers = {}  # source_id -> Sort
+        self.last_seen = {}  # source_id -> number of the last batch with a frame of the source
+        self.last_frame_nums = {}  # source_id -> number of the last frame of the source
+        self.metrics = {}  # source_id -> (frames counter, active tracks gauge, dropped frames counter)
+        self.batch_count = 0
+        self.idle_batches = 300
+        self.workers = 1
+        self.executor = None
         super(GstSORT, self).__init__()
 
+    def do_get_property(self, prop: GObject.GParamSpec):
+        if prop.name == 'idle-batches':
+            return self.idle_batches
+        elif prop.name == 'workers':
+            return self.workers
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop: GObject.GParamSpec, value):
+        if prop.name == 'idle-batches':
+            self.idle_batches = value
+        elif prop.name == 'workers':
+            self.workers = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.trackers.clear()
+        self.last_seen.clear()
+        self.last_frame_nums.clear()
+        return True
+
+    def source_metrics(self, source_id):
+        """ Returns the cached frames counter, active tracks gauge and dropped frames counter of the source """
+        metrics = self.metrics.get(source_id)
+        if metrics is None:
+            element = self.get_name()
+            metrics = self.metrics[source_id] = (
+                REGISTRY.counter('tracking_frames_total', 'Frames processed', element=element, source=source_id),
+                REGISTRY.gauge('tracking_active_tracks', 'Tracks alive in the tracker', element=element,
+                               source=source_id),
+                REGISTRY.counter('tracking_dropped_frames_total', 'Frames of the source that never reached the tracker',
+                                 element=element, source=source_id))
+        return metrics
+
+    def get_tracker(self, source_id):
+        """ Returns the tracker of the source, creating it on the first frame of the source """
+        sort = self.trackers.get(source_id)
+        if sort is None:
+            sort = self.trackers[source_id] = Sort()
+        self.last_seen[source_id] = self.batch_count
+        return sort
+
+    def evict_idle_trackers(self):
+        """ Drops trackers of sources that have not sent frames for idle_batches batches """
+        for source_id, last_seen in list(self.last_seen.items()):
+            if self.batch_count - last_seen > self.idle_batches:
+                del self.trackers[source_id]
+                del self.last_seen[source_id]
+                self.last_frame_nums.pop(source_id, None)
+                self.source_metrics(source_id)[1].set(0)
+
+    def track_source(self, source_id, frames):
+        """ Runs the tracker of the source over its frames of the batch in order """
+        sort = self.get_tracker(source_id)
+        frames_metric, tracks_metric, dropped_metric = self.source_metrics(source_id)
+        results = []
+        for infer_done, frame_meta, detected_objects, _ in frames:
+            # frames dropped upstream, e.g. by a leaky queue or the muxer, leave gaps in frame numbers
+            last_frame_num = self.last_frame_nums.get(source_id)
+            if last_frame_num is not None and frame_meta.frame_num > last_frame_num + 1:
+                dropped_metric.inc(frame_meta.frame_num - last_frame_num - 1)
+            self.last_frame_nums[source_id] = frame_meta.frame_num
+            if infer_done:
+                results.append(sort.update(detected_objects, 5, return_indices=True))
+            else:
+                # the detector skipped the frame, so it is filled with predictions
+                results.append((sort.predict(), None))
+
+        frames_metric.inc(len(frames))
+        tracks_metric.set(len(sort.trackers))
+        return results
+
+    @staticmethod
+    def add_predicted_objects(batch_meta, frame_meta, tracks):
+        """ Adds tracks predicted on a frame without detections to the frame as objects """
+        for track in tracks:
+            obj_meta = pyds.nvds_acquire_obj_meta_from_pool(batch_meta)
+            obj_meta.class_id = int(track[5])
+            obj_meta.object_id = int(track[4])
+            obj_meta.confidence = -0.1  # negative confidence marks objects without a detection
+            obj_meta.rect_params.left = track[0]
+            obj_meta.rect_params.top = track[1]
+            obj_meta.rect_params.width = track[2] - track[0]
+            obj_meta.rect_params.height = track[3] - track[1]
+            obj_meta.rect_params.border_width = 2
+            pyds.nvds_add_obj_meta_to_frame(frame_meta, obj_meta, None)
+
     def do_transform_ip(self, buf):
         batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
         l_frame = batch_meta.frame_meta_list
+        self.batch_count += 1
 
+        # group frames by source, so every source is tracked independently
+        sources = {}
         while l_frame is not None:
             try:
                 frame_meta = pyds.glist_get_nvds_frame_meta(l_frame.data)
@@ -97,22 +213,29 @@ class GstSORT(GstBase.BaseTransform):
                 except StopIteration:
                     break
 
-            self.tracks = self.sort.update(np.array(detected_objects), 5)
-
-            for object_index in range(len(self.tracks)):
-                for detected_object_index in range(len(detected_objects)):
-                    x = round(detected_objects[detected_object_index][0])
-                    y = round(detected_objects[detected_object_index][1])
-                    if (x - 2.5 < self.tracks[object_index][0] < x + 2.5) and (
-                            y - 2.5 < self.tracks[object_index][1] < y + 2.5):
-                        obj_id = int(self.tracks[object_index][4])
-                        if obj_id is not None:
-                            objects_meta[detected_object_index].object_id = obj_id
-                        break
+            sources.setdefault(frame_meta.source_id, []).append(
+                (frame_meta.bInferDone, frame_meta, np.array(detected_objects), objects_meta))
             try:
                 l_frame = l_frame.next
             except StopIteration:
                 break
+
+        if self.workers > 1 and len(sources) > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            results = list(self.executor.map(self.track_source, sources.keys(), sources.values()))
+        else:
+            results = [self.track_source(source_id, frames) for source_id, frames in sources.items()]
+
+        for frames, frames_tracks in zip(sources.values(), results):
+            for (_, frame_meta, _, objects_meta), (tracks, det_indices) in zip(frames, frames_tracks):
+                if det_indices is None:
+                    self.add_predicted_objects(batch_meta, frame_meta, tracks)
+                    continue
+                for track, det_index in zip(tracks, det_indices):
+                    objects_meta[det_index].object_id = int(track[4])
+
+        self.evict_idle_trackers()
         return Gst.FlowReturn.OK
 
 register_by_name(GST_SORT)
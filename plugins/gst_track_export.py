@@ -0,0 +1,201 @@
+import sys
+import time
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+from gi.repository import Gst, GObject, GstBase
+sys.path.append('../')
+import common.is_aarch_64
+import common.bus_call
+from common.metrics import REGISTRY
+import pyds
+from .track_export import TrackWriter
+
+TRACK_EXPORT = 'trackexport'
+UNTRACKED_OBJECT_ID = 0xFFFFFFFFFFFFFFFF
+
+# Standard GStreamer initialization
+GObject.threads_init()
+Gst.init(None)
+
+
+def register(plugin):
+    type_to_register = GObject.type_register(TrackExport)
+    return Gst.Element.register(plugin, TRACK_EXPORT, 0, type_to_register)
+
+
+def register_by_name(plugin_name):
+    name = plugin_name
+    description = "Exports tracked objects from Deepstream metadata to a file"
+    version = '0.1.0'
+    gst_license = 'LGPL'
+    source_module = 'gstreamer'
+    package = 'trackexport'
+    origin = 'MLab'
+    if not Gst.Plugin.register_static(Gst.VERSION_MAJOR, Gst.VERSION_MINOR,
+                                      name, description,
+                                      register, version, gst_license,
+                                      source_module, package, origin):
+        raise ImportError("Plugin {} not registered".format(plugin_name))
+    return True
+
+
+class TrackExport(GstBase.BaseTransform):
+    __gstmetadata__ = ("TrackExport",
+                       "BaseTransform",
+                       "Export tracks",
+                       "MLab")
+
+    __gsttemplates__ = (Gst.PadTemplate.new("src",
+                                            Gst.PadDirection.SRC,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")),
+                        Gst.PadTemplate.new("sink",
+                                            Gst.PadDirection.SINK,
+                                            Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string("video/x-raw,"
+                                                                 "format=(string)RGBA,"
+                                                                 "width=[1,2147483647],"
+                                                                 "height=[1,2147483647],"
+                                                                 "framerate=[0/1,2147483647/1]")))
+
+    __gproperties__ = {
+        "location": (GObject.TYPE_PYOBJECT,
+                     "location",
+                     "A property that contains the path to the export file",
+                     GObject.ParamFlags.READWRITE
+                     ),
+        "format": (GObject.TYPE_PYOBJECT,
+                   "format",
+                   "A property that contains the export format: jsonl, csv or binary",
+                   GObject.ParamFlags.READWRITE
+                   ),
+        "flush-size": (GObject.TYPE_PYOBJECT,
+                       "flush-size",
+                       "A property that contains the number of tracks collected before they are handed to the writer",
+                       GObject.ParamFlags.READWRITE
+                       ),
+        "flush-interval": (GObject.TYPE_PYOBJECT,
+                           "flush-interval",
+                           "A property that contains the maximum number of seconds tracks wait for the writer, "
+                           "it is checked when a buffer arrives, so tracks of a stalled stream wait for the next "
+                           "buffer or the stop of the element",
+                           GObject.ParamFlags.READWRITE
+                           ),
+        "queue-size": (GObject.TYPE_PYOBJECT,
+                       "queue-size",
+                       "A property that contains the number of batches waiting for the writer "
+                       "before new batches are dropped",
+                       GObject.ParamFlags.READWRITE
+                       ),
+        "dropped": (GObject.TYPE_PYOBJECT,
+                    "dropped",
+                    "A property that contains the number of tracks dropped because the writer fell behind",
+                    GObject.ParamFlags.READABLE
+                    )
+    }
+
+    def __init__(self):
+        self.location = None
+        self.format = 'jsonl'
+        self.flush_size = 4096
+        self.flush_interval = 1.
+        self.queue_size = 8
+        self.writer = None
+        self.rows = []
+        self.last_flush = 0.
+        self.dropped_metric = None
+        super(TrackExport, self).__init__()
+
+    def do_get_property(self, prop: GObject.GParamSpec):
+        if prop.name == 'location':
+            return self.location
+        elif prop.name == 'format':
+            return self.format
+        elif prop.name == 'flush-size':
+            return self.flush_size
+        elif prop.name == 'flush-interval':
+            return self.flush_interval
+        elif prop.name == 'queue-size':
+            return self.queue_size
+        elif prop.name == 'dropped':
+            return self.writer.dropped if self.writer is not None else 0
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_set_property(self, prop: GObject.GParamSpec, value):
+        if prop.name == 'location':
+            self.location = value
+        elif prop.name == 'format':
+            self.format = value
+        elif prop.name == 'flush-size':
+            self.flush_size = value
+        elif prop.name == 'flush-interval':
+            self.flush_interval = value
+        elif prop.name == 'queue-size':
+            self.queue_size = value
+        else:
+            raise AttributeError('unknown property %s' % prop.name)
+
+    def do_start(self):
+        self.writer = TrackWriter(self.location, self.format, self.queue_size)
+        self.dropped_metric = REGISTRY.counter('tracking_export_dropped_total',
+                                               'Tracks dropped because the export writer fell behind',
+                                               element=self.get_name())
+        self.rows = []
+        self.last_flush = time.monotonic()
+        return True
+
+    def do_stop(self):
+        # the rest is written synchronously, nothing streams any more
+        self.writer.close(self.rows)
+        self.rows = []
+        return True
+
+    def flush(self):
+        """ Hands the collected tracks to the writer, they are dropped if its queue is full """
+        if not self.writer.submit(self.rows):
+            self.dropped_metric.inc(len(self.rows))
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def do_transform_ip(self, buf):
+        batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
+        l_frame = batch_meta.frame_meta_list
+        while l_frame is not None:
+            try:
+                frame_meta = pyds.glist_get_nvds_frame_meta(l_frame.data)
+            except StopIteration:
+                break
+
+            l_obj = frame_meta.obj_meta_list
+            while l_obj is not None:
+                try:
+                    obj_meta = pyds.glist_get_nvds_object_meta(l_obj.data)
+                except StopIteration:
+                    break
+                if obj_meta.object_id != UNTRACKED_OBJECT_ID:
+                    rect = obj_meta.rect_params
+                    self.rows.append((frame_meta.source_id, frame_meta.frame_num, obj_meta.object_id,
+                                      obj_meta.class_id, obj_meta.confidence,
+                                      (rect.left, rect.top, rect.width, rect.height)))
+                try:
+                    l_obj = l_obj.next
+                except StopIteration:
+                    break
+            try:
+                l_frame = l_frame.next
+            except StopIteration:
+                break
+
+        if len(self.rows) >= self.flush_size or \
+                (self.rows and time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+        return Gst.FlowReturn.OK
+
+
+register_by_name(TRACK_EXPORT)
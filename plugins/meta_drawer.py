@@ -2,6 +2,7 @@ import numpy as np
 import cv2
 import sys
 import gi
+from collections import OrderedDict
 from typing import NamedTuple
 
 gi.require_version('Gst', '1.0')
@@ -21,6 +22,12 @@ DEFAULT_BBOX_COLORS = [
     (75.0, 75.0, 255.0),
     (75.0, 255.0, 75.0)
 ]
+DEFAULT_LABEL_CACHE_SIZE = 512
+FONT_COLOR = (255, 255, 255)
+FONT_BG_COLOR = (0, 0, 0)
+FONT_SCALE = 0.5
+FONT_FACE = cv2.FONT_HERSHEY_SIMPLEX
+FONT_THICKNESS = 1
 
 # Standard GStreamer initialization
 GObject.threads_init()
@@ -38,30 +45,81 @@ class DisplayedObject(NamedTuple):
     text: str
 
 
-def draw_meta(frame, objects_meta):
-    """ Draw object borders, ids, confidence """
+def render_label(text, font_scale, font_color, font_bg_color):
+    """ Renders text on its background into an RGBA bitmap, the baseline is 3 pixels above the bottom """
+    size, base_line = cv2.getTextSize(text, FONT_FACE, font_scale, FONT_THICKNESS)
+    label = np.zeros((size[1] + 4, size[0] + 1, 4), dtype=np.uint8)
+    cv2.rectangle(label, (0, 0), (size[0], size[1] + 3), font_bg_color, -1)
+    cv2.putText(label, text, (0, size[1]), FONT_FACE, font_scale, font_color, FONT_THICKNESS)
+    return label
+
+
+class LabelCache(object):
+    """ Bounded LRU cache of pre-rendered label bitmaps keyed by text, font scale and colors """
+
+    def __init__(self, size=DEFAULT_LABEL_CACHE_SIZE):
+        self.size = size
+        self.labels = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, font_scale=FONT_SCALE, font_color=FONT_COLOR, font_bg_color=FONT_BG_COLOR):
+        key = (text, font_scale, font_color, font_bg_color)
+        label = self.labels.get(key)
+        if label is not None:
+            self.hits += 1
+            self.labels.move_to_end(key)
+            return label
+
+        self.misses += 1
+        label = self.labels[key] = render_label(text, font_scale, font_color, font_bg_color)
+        while len(self.labels) > self.size:
+            self.labels.popitem(last=False)
+        return label
+
+
+def draw_label(frame, text, left_bottom, font_scale=FONT_SCALE, font_color=FONT_COLOR, font_bg_color=FONT_BG_COLOR):
+    """ Draws text on its background directly into the frame, the baseline is at left_bottom """
+    size, base_line = cv2.getTextSize(text, FONT_FACE, font_scale, FONT_THICKNESS)
+    bg_left_top = (left_bottom[0], left_bottom[1] - size[1])
+    bg_right_bottom = (left_bottom[0] + size[0], left_bottom[1] + 3)
+    cv2.rectangle(frame, bg_left_top, bg_right_bottom, font_bg_color, -1)
+    cv2.putText(frame, text, left_bottom, FONT_FACE, font_scale, font_color, FONT_THICKNESS)
+
+
+def blit(frame, bitmap, left, top):
+    """
+    Copies the bitmap to the frame at the left top corner.
+    Returns False without drawing if the bitmap does not fit into the frame, OpenCV clips glyphs at the
+    frame borders differently from a clipped bitmap, so such labels have to be drawn directly.
+    """
+    height, width = frame.shape[:2]
+    if left < 0 or top < 0 or left + bitmap.shape[1] > width or top + bitmap.shape[0] > height:
+        return False
+    frame[top:top + bitmap.shape[0], left:left + bitmap.shape[1]] = bitmap
+    return True
+
+
+def draw_meta(frame, objects_meta, labels):
+    """ Draw object borders, ids, confidence in place, touching only the regions of objects """
     alpha = 0.15
-    overlay = frame.copy()
-    font_color = (255, 255, 255)
-    font_bg_color = (0, 0, 0)
-    font_scale = 0.5
-    font_face = cv2.FONT_HERSHEY_SIMPLEX
-    font_thickness = 1
+    height, width = frame.shape[:2]
 
     for obj_meta in objects_meta:
-        # draw the transparent bbox
-        cv2.rectangle(overlay, obj_meta.bbox.left_top, obj_meta.bbox.right_bottom, obj_meta.bbox.color, -1)
+        # blend the transparent bbox inside its clipped region only
+        left, top = max(obj_meta.bbox.left_top[0], 0), max(obj_meta.bbox.left_top[1], 0)
+        right, bottom = min(obj_meta.bbox.right_bottom[0], width), min(obj_meta.bbox.right_bottom[1], height)
+        if right > left and bottom > top:
+            roi = frame[top:bottom, left:right]
+            cv2.addWeighted(roi, 1 - alpha, roi, 0, 0, dst=roi)
+            cv2.add(roi, tuple(alpha * c for c in obj_meta.bbox.color) + (0,), dst=roi)
         cv2.rectangle(frame, obj_meta.bbox.left_top, obj_meta.bbox.right_bottom, obj_meta.bbox.color, 1)
 
-        # draw text and the text backgrounds
+        # draw the pre-rendered text with its background, labels crossing the frame borders are drawn directly
         if obj_meta.text is not None:
-            size, base_line = cv2.getTextSize(obj_meta.text, font_face, font_scale, font_thickness)
-            bg_left_top = (obj_meta.bbox.left_top[0], obj_meta.bbox.left_top[1] - size[1])
-            bg_right_bottom = (obj_meta.bbox.left_top[0] + size[0], obj_meta.bbox.left_top[1] + 3)
-            cv2.rectangle(frame, bg_left_top, bg_right_bottom, font_bg_color, -1)
-            cv2.putText(frame, obj_meta.text, obj_meta.bbox.left_top, font_face, font_scale, font_color, font_thickness)
-
-    cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0, frame)
+            label = labels.get(obj_meta.text)
+            if not blit(frame, label, obj_meta.bbox.left_top[0], obj_meta.bbox.left_top[1] + 4 - label.shape[0]):
+                draw_label(frame, obj_meta.text, obj_meta.bbox.left_top)
 
 
 def register(plugin):
@@ -115,34 +173,74 @@ class MetaDrawer(GstBase.BaseTransform):
                         "bbox-colors",
                         "A property that contains the list of colors for bboxes",
                         GObject.ParamFlags.READWRITE
-                        )
+                        ),
+        "label-cache-size": (GObject.TYPE_PYOBJECT,
+                             "label-cache-size",
+                             "A property that contains the maximum number of cached label bitmaps",
+                             GObject.ParamFlags.READWRITE
+                             ),
+        "label-cache-hits": (GObject.TYPE_PYOBJECT,
+                             "label-cache-hits",
+                             "A property that contains the number of labels taken from the cache",
+                             GObject.ParamFlags.READABLE
+                             ),
+        "label-cache-misses": (GObject.TYPE_PYOBJECT,
+                               "label-cache-misses",
+                               "A property that contains the number of labels rendered",
+                               GObject.ParamFlags.READABLE
+                               )
     }
 
     def __init__(self):
         self.bbox_colors = DEFAULT_BBOX_COLORS
+        self.labels = LabelCache()
 
         super(MetaDrawer, self).__init__()
 
     def do_get_property(self, prop: GObject.GParamSpec):
         if prop.name == 'bbox-colors':
             return self.bbox_colors
+        elif prop.name == 'label-cache-size':
+            return self.labels.size
+        elif prop.name == 'label-cache-hits':
+            return self.labels.hits
+        elif prop.name == 'label-cache-misses':
+            return self.labels.misses
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
     def do_set_property(self, prop: GObject.GParamSpec, value):
         if prop.name == 'bbox-colors':
             self.bbox_colors = value
+        elif prop.name == 'label-cache-size':
+            self.labels.size = value
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
+    def get_frames(self, mapped, width, height):
+        """ Splits the mapped buffer into the (batch, height, width, channels) array of its frames """
+        frame_size = height * width * self.CHANNELS
+        return np.ndarray((len(mapped) // frame_size, height, width, self.CHANNELS), buffer=mapped, dtype=np.uint8)
+
     def do_transform_ip(self, buf):
         success, (width, height) = get_buffer_size(self.srcpad.get_current_caps())
         if not success:
             return Gst.FlowReturn.ERROR
 
-        with map_gst_buffer(buf, Gst.MapFlags.READ) as mapped:
-            frame = np.ndarray((height, width, self.CHANNELS), buffer=mapped, dtype=np.uint8)
+        # draw straight into a single writable mapping of the buffer
+        refcount = buf.mini_object.refcount
+        buf.mini_object.refcount = 1
+        try:
+            with map_gst_buffer(buf, Gst.MapFlags.READ | Gst.MapFlags.WRITE) as mapped:
+                frames = self.get_frames(mapped, width, height)
+                self.draw_batch(buf, frames)
+        finally:
+            buf.mini_object.refcount += refcount - 1
+
+        return Gst.FlowReturn.OK
 
+    def draw_batch(self, buf, frames):
+        """ Draws objects of every frame meta of the buffer on its frame """
         batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(buf))
         l_frame = batch_meta.frame_meta_list
         while l_frame is not None:
@@ -155,10 +253,10 @@ class MetaDrawer(GstBase.BaseTransform):
             while l_obj is not None:
                 try:
                     obj_meta = pyds.glist_get_nvds_object_meta(l_obj.data)
-                    left_top = (obj_meta.rect_params.left,
-                                obj_meta.rect_params.top)
-                    right_bottom = (obj_meta.rect_params.left + obj_meta.rect_params.width,
-                                    obj_meta.rect_params.top + obj_meta.rect_params.height)
+                    left_top = (int(obj_meta.rect_params.left),
+                                int(obj_meta.rect_params.top))
+                    right_bottom = (int(obj_meta.rect_params.left + obj_meta.rect_params.width),
+                                    int(obj_meta.rect_params.top + obj_meta.rect_params.height))
                     color = self.bbox_colors[obj_meta.class_id % len(self.bbox_colors)]
                     bbox = BBox(left_top, right_bottom, color)
                     text = None
@@ -169,21 +267,10 @@ class MetaDrawer(GstBase.BaseTransform):
                 except StopIteration:
                     break
             try:
-                draw_meta(frame, objects_meta)
+                draw_meta(frames[frame_meta.batch_id], objects_meta, self.labels)
                 l_frame = l_frame.next
             except StopIteration:
                 break
 
-        refcount = buf.mini_object.refcount
-        buf.mini_object.refcount = 1
-
-        with map_gst_buffer(buf, Gst.MapFlags.READ | Gst.MapFlags.WRITE) as mapped:
-            out = np.ndarray((height, width, self.CHANNELS), buffer=mapped, dtype=np.uint8)
-            out[:] = frame
-
-        buf.mini_object.refcount += refcount - 1
-
-        return Gst.FlowReturn.OK
-
 
 register_by_name(META_DRAWER)
\ No newline at end of file
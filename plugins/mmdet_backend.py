@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+from functools import partial
+
+import numpy as np
+import torch
+from mmcv import Config
+from mmdet.apis import init_detector
+from .preprocess import Preprocessor
+
+BACKENDS = ('pytorch', 'onnxruntime')
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gst-mmdet')
+CHUNK_SIZE = 1 << 20
+
+
+def model_key(cfg, checkpoint):
+    """ Returns the hash of the resolved config and the checkpoint contents naming exported models """
+    digest = hashlib.sha256(cfg.pretty_text.encode('utf-8'))
+    with open(checkpoint, 'rb') as checkpoint_file:
+        for chunk in iter(lambda: checkpoint_file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def export_onnx(config, checkpoint, cfg, path):
+    """
+    Exports the detector with dynamic batch and input size to ONNX next to a json with its class names.
+    Files are written under temporary names and renamed, so a concurrent start never sees a partial export.
+    """
+    from mmdet.core.export import build_model_from_cfg
+
+    model = build_model_from_cfg(config, checkpoint)
+    preprocessor = Preprocessor(cfg, 'cpu')
+    width, height = max(preprocessor.img_scale), min(preprocessor.img_scale)
+    img, img_metas = preprocessor([np.zeros((height, width, 4), dtype=np.uint8)])
+    model.forward = partial(model.forward, img_metas=[img_metas], return_loss=False, rescale=False)
+
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    torch.onnx.export(model, [img], temp_path,
+                      input_names=['input'],
+                      output_names=['dets', 'labels'],
+                      export_params=True,
+                      keep_initializers_as_inputs=True,
+                      do_constant_folding=True,
+                      opset_version=11,
+                      dynamic_axes={
+                          'input': {0: 'batch', 2: 'height', 3: 'width'},
+                          'dets': {0: 'batch', 1: 'num_dets'},
+                          'labels': {0: 'batch', 1: 'num_dets'}
+                      })
+    with open(temp_path + '.json', 'w') as classes_file:
+        json.dump(list(model.CLASSES), classes_file)
+    os.replace(temp_path + '.json', path + '.json')
+    os.replace(temp_path, path)
+
+
+def load_detector(config, checkpoint, backend='pytorch', device='cuda:0', cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the detector called like an mmdet model and its config.
+    The onnxruntime backend exports the model once and loads it from cache_dir afterwards
+    without building the PyTorch model.
+    """
+    if backend == 'pytorch':
+        model = init_detector(config, checkpoint, device=device)
+        return model, model.cfg
+    if backend != 'onnxruntime':
+        raise ValueError("unknown backend %s, expected one of %s" % (backend, ', '.join(BACKENDS)))
+
+    from mmdet.core.export.model_wrappers import ONNXRuntimeDetector
+
+    cfg = Config.fromfile(config)
+    path = os.path.join(cache_dir, model_key(cfg, checkpoint) + '.onnx')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        export_onnx(config, checkpoint, cfg, path)
+    with open(path + '.json') as classes_file:
+        class_names = json.load(classes_file)
+
+    device = torch.device(device)
+    model = ONNXRuntimeDetector(path, class_names, device.index or 0)
+    if device.type == 'cpu' and model.is_cuda_available:
+        # onnxruntime-gpu picks CUDA whenever it can
+        model.sess.set_providers(['CPUExecutionProvider'])
+        model.is_cuda_available = False
+    return model, cfg
+
+
+def infer(model, img, img_metas):
+    """ Runs the detector on a preprocessed batch and returns mmdet results of its frames """
+    with torch.no_grad():
+        return model(return_loss=False, rescale=True, img=[img], img_metas=[img_metas])
+
+
+def warm_up(model, preprocessor, runs):
+    """ Runs the detector on a blank frame of the network input scale, so the first frame does not pay for setup """
+    width, height = max(preprocessor.img_scale), min(preprocessor.img_scale)
+    frame = np.zeros((height, width, 4), dtype=np.uint8)
+    for _ in range(runs):
+        infer(model, *preprocessor([frame]))
@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    """
+    Decides whether a frame needs detection by comparing its downscaled grayscale copy with the copy of
+    the last detected frame of the source. Frames are compared with the last detected frame rather than
+    the previous one, so slow changes add up until they open the gate.
+    """
+
+    def __init__(self, threshold=0.01, max_skipped=30, pixel_threshold=16, width=64):
+        """
+        threshold is the ratio of changed pixels opening the gate, a pixel is changed when its gray level
+        differs by more than pixel_threshold. After max_skipped skipped frames the next frame is detected anyway.
+        """
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.references = {}  # source_id -> downscaled gray frame of the last detected frame
+        self.skipped = {}  # source_id -> number of frames skipped since then
+        self.difference = None
+
+    def downscale(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.width, max(1, int(round(height * self.width / width))))
+        # pixels are sampled with a stride first, so averaging touches a few times the output size only
+        step = max(1, width // (self.width * 4))
+        frame = np.ascontiguousarray(frame[::step, ::step])
+        return cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_RGBA2GRAY)
+
+    def __call__(self, source_id, frame):
+        """ Returns True if the RGBA frame of the source has to be detected """
+        small = self.downscale(frame)
+        reference = self.references.get(source_id)
+        skipped = self.skipped.get(source_id, 0)
+        if reference is not None and reference.shape == small.shape and skipped < self.max_skipped:
+            if self.difference is None or self.difference.shape != small.shape:
+                self.difference = np.empty_like(small)
+            cv2.absdiff(small, reference, dst=self.difference)
+            changed = np.count_nonzero(self.difference > self.pixel_threshold)
+            if changed < self.threshold * small.size:
+                self.skipped[source_id] = skipped + 1
+                return False
+        self.references[source_id] = small
+        self.skipped[source_id] = 0
+        return True
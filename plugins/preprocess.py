@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+import torch
+
+
+def find_transform(pipeline, transform_type):
+    """ Returns the first transform of the type in a (possibly nested) mmdet data pipeline """
+    for transform in pipeline:
+        if transform['type'] == transform_type:
+            return transform
+        if 'transforms' in transform:
+            nested = find_transform(transform['transforms'], transform_type)
+            if nested is not None:
+                return nested
+    return None
+
+
+class PreprocessBuffers(object):
+    """
+    Persistent buffers for frames of one resolution: resized RGBA frame, converted colors and
+    the padded (batch, 3, height, width) network input.
+    """
+
+    def __init__(self, resized_shape, padded_shape, batch_size):
+        height, width = resized_shape
+        self.resized = np.empty((height, width, 4), dtype=np.uint8)
+        self.colors = np.empty((height, width, 3), dtype=np.uint8)
+        # padding stays zero forever since every frame of the resolution fills the same region
+        self.batch = np.zeros((batch_size, 3) + padded_shape, dtype=np.float32)
+
+    def reserve(self, batch_size):
+        if batch_size > len(self.batch):
+            batch = np.zeros((batch_size,) + self.batch.shape[1:], dtype=np.float32)
+            batch[:len(self.batch)] = self.batch
+            self.batch = batch
+
+
+class Preprocessor(object):
+    """
+    Performs resize, color conversion, normalization and padding of the mmdet test pipeline
+    directly on RGBA frames into buffers allocated once per frame resolution.
+    Returns network input tensor with image metas ready to be passed to the model.
+    """
+
+    def __init__(self, cfg, device, slots=1, keep_scale=False):
+        """
+        Reads the test pipeline of the mmdet config.
+        slots is the number of batches that may be in use at once, e.g. by an inference thread.
+        With keep_scale frames are not resized to the config scale, only normalized and padded.
+        """
+        pipeline = cfg.data.test.pipeline
+        aug = find_transform(pipeline, 'MultiScaleFlipAug')
+        resize = find_transform(pipeline, 'Resize')
+        normalize = find_transform(pipeline, 'Normalize')
+        pad = find_transform(pipeline, 'Pad')
+
+        img_scale = aug['img_scale'] if aug is not None else resize['img_scale']
+        self.img_scale = img_scale[0] if isinstance(img_scale, list) else img_scale
+        self.keep_ratio = resize.get('keep_ratio', True)
+        self.keep_scale = keep_scale
+        self.mean = np.array(normalize['mean'], dtype=np.float32)
+        self.std = np.array(normalize['std'], dtype=np.float32)
+        self.to_rgb = normalize.get('to_rgb', True)
+        self.std_inv = (1. / self.std)[:, np.newaxis, np.newaxis]
+        self.pad_size = pad.get('size') if pad is not None else None
+        self.pad_divisor = pad.get('size_divisor') if pad is not None else None
+
+        self.device = device
+        self.slots = slots
+        self.slot = 0
+        self.buffers = {}  # (slot, height, width) -> PreprocessBuffers
+        self.img_metas = {}  # (height, width) -> image meta
+
+    def get_resized_shape(self, height, width):
+        """ Returns (height, width) of the frame resized like mmcv does and (w_scale, h_scale) """
+        if self.keep_scale:
+            return (height, width), (1., 1.)
+        if self.keep_ratio:
+            scale = min(max(self.img_scale) / max(height, width), min(self.img_scale) / min(height, width))
+            new_width, new_height = int(width * scale + 0.5), int(height * scale + 0.5)
+        else:
+            new_width, new_height = self.img_scale
+        return (new_height, new_width), (new_width / width, new_height / height)
+
+    def get_padded_shape(self, height, width):
+        if self.pad_size is not None:
+            return tuple(self.pad_size)
+        if self.pad_divisor is not None:
+            return (int(np.ceil(height / self.pad_divisor)) * self.pad_divisor,
+                    int(np.ceil(width / self.pad_divisor)) * self.pad_divisor)
+        return height, width
+
+    def get_img_meta(self, height, width):
+        """ Returns the image meta shared by all frames of the resolution """
+        img_meta = self.img_metas.get((height, width))
+        if img_meta is None:
+            resized_shape, (w_scale, h_scale) = self.get_resized_shape(height, width)
+            padded_shape = self.get_padded_shape(*resized_shape)
+            img_meta = self.img_metas[(height, width)] = dict(
+                filename=None,
+                ori_filename=None,
+                ori_shape=(height, width, 3),
+                img_shape=resized_shape + (3,),
+                pad_shape=padded_shape + (3,),
+                batch_input_shape=padded_shape,
+                scale_factor=np.array([w_scale, h_scale, w_scale, h_scale], dtype=np.float32),
+                flip=False,
+                flip_direction=None,
+                img_norm_cfg=dict(mean=self.mean, std=self.std, to_rgb=self.to_rgb))
+        return img_meta
+
+    def get_buffers(self, height, width, batch_size):
+        key = (self.slot, height, width)
+        buffers = self.buffers.get(key)
+        if buffers is None:
+            img_meta = self.get_img_meta(height, width)
+            buffers = self.buffers[key] = PreprocessBuffers(img_meta['img_shape'][:2],
+                                                            img_meta['pad_shape'][:2], batch_size)
+        buffers.reserve(batch_size)
+        return buffers
+
+    def __call__(self, frames):
+        """
+        Preprocesses RGBA frames of the same resolution, the frames may be unmapped right after the call.
+        Returns (batch, 3, height, width) tensor on the model device and the list of image metas.
+        On CPU the tensor shares memory with the slot, so it stays valid until the slot comes round again.
+        """
+        height, width = frames[0].shape[:2]
+        img_meta = self.get_img_meta(height, width)
+        buffers = self.get_buffers(height, width, len(frames))
+        self.slot = (self.slot + 1) % self.slots
+
+        resized_height, resized_width = img_meta['img_shape'][:2]
+        for i, frame in enumerate(frames):
+            if not self.keep_scale:
+                frame = cv2.resize(frame, (resized_width, resized_height), dst=buffers.resized,
+                                   interpolation=cv2.INTER_LINEAR)
+            cv2.cvtColor(frame, cv2.COLOR_RGBA2RGB if self.to_rgb else cv2.COLOR_RGBA2BGR, dst=buffers.colors)
+            img = buffers.batch[i, :, :resized_height, :resized_width]
+            np.subtract(buffers.colors.transpose(2, 0, 1), self.mean[:, np.newaxis, np.newaxis], out=img)
+            np.multiply(img, self.std_inv, out=img)
+
+        img = torch.from_numpy(buffers.batch[:len(frames)]).to(self.device)
+        return img, [img_meta] * len(frames)
@@ -14,125 +14,289 @@
 """
 from __future__ import print_function
 
-from numba import jit
 import numpy as np
-from filterpy.kalman import KalmanFilter
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from collections import deque, Counter
+import itertools
 
+# smaller problems are solved densely, gating costs more than it saves on them: on crowded 1080p scenes
+# it measured slower at 150 x 150 objects (2.5 ms vs 1.8 ms), about even at 200 x 200 and faster from
+# 250 x 250 on (3.5 ms vs 5.1 ms, 5.0 ms vs 21.0 ms at 500 x 500)
+GATING_MIN_PAIRS = 40000
 
-@jit
-def iou(bb_test, bb_gt):
+
+def iou_boxes(bb_test, bb_gt):
     """
-    Computes IUO between two bboxes in the form [x1,y1,x2,y2]
+    Computes IOU between bboxes in the form [...,[x1,y1,x2,y2]], the arrays broadcast against each other
     """
-    xx1 = np.maximum(bb_test[0], bb_gt[0])
-    yy1 = np.maximum(bb_test[1], bb_gt[1])
-    xx2 = np.minimum(bb_test[2], bb_gt[2])
-    yy2 = np.minimum(bb_test[3], bb_gt[3])
+    xx1 = np.maximum(bb_test[..., 0], bb_gt[..., 0])
+    yy1 = np.maximum(bb_test[..., 1], bb_gt[..., 1])
+    xx2 = np.minimum(bb_test[..., 2], bb_gt[..., 2])
+    yy2 = np.minimum(bb_test[..., 3], bb_gt[..., 3])
     w = np.maximum(0., xx2 - xx1)
     h = np.maximum(0., yy2 - yy1)
     wh = w * h
-    o = wh / ((bb_test[2] - bb_test[0]) * (bb_test[3] - bb_test[1])
-              + (bb_gt[2] - bb_gt[0]) * (bb_gt[3] - bb_gt[1]) - wh)
-    return (o)
+    o = wh / ((bb_test[..., 2] - bb_test[..., 0]) * (bb_test[..., 3] - bb_test[..., 1])
+              + (bb_gt[..., 2] - bb_gt[..., 0]) * (bb_gt[..., 3] - bb_gt[..., 1]) - wh)
+    return o.astype(np.float32)
+
+
+def iou_batch(bb_test, bb_gt):
+    """
+    Computes IOU between every pair of bboxes in the form [x1,y1,x2,y2]
+    Returns a matrix of shape (len(bb_test), len(bb_gt))
+    """
+    bb_test = np.asarray(bb_test, dtype=np.float64)[:, np.newaxis, :4]
+    bb_gt = np.asarray(bb_gt, dtype=np.float64)[np.newaxis, :, :4]
+    return iou_boxes(bb_test, bb_gt)
+
+
+def grid_cells(lo, hi, rows):
+    """
+    Lists grid cells covered by boxes spanning cells lo to hi inclusive.
+    Returns box indices and cell keys, one entry per covered cell.
+    """
+    spans = hi - lo + 1
+    counts = spans[:, 0] * spans[:, 1]
+    boxes = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    heights = spans[boxes, 1]
+    keys = (lo[boxes, 0] + offsets // heights) * rows + lo[boxes, 1] + offsets % heights
+    return boxes, keys
 
 
-def convert_bbox_to_z(bbox):
+def overlapping_pairs(detections, trackers):
     """
-    Takes a bounding box in the form [x1,y1,x2,y2] and returns z in the form
-      [x,y,s,r] where x,y is the centre of the box and s is the scale/area and r is
+    Finds pairs of detections and trackers that overlap at all by hashing the boxes into a uniform grid
+    with cells of the median box size, so only boxes sharing a cell are compared.
+    Returns detection indices, tracker indices and IOU of the pairs, None when the boxes are too
+    spread out in size for the grid to prune anything.
+    """
+    boxes = np.vstack((detections[:, :4], trackers[:, :4])).astype(np.float64)
+    cell = max(np.median(np.concatenate((boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))), 1.)
+    origin = boxes[:, :2].min(axis=0)
+    lo = np.floor((boxes[:, :2] - origin) / cell).astype(np.int64)
+    hi = np.maximum(np.floor((boxes[:, 2:4] - origin) / cell).astype(np.int64), lo)
+    spans = hi - lo + 1
+    if (spans[:, 0] * spans[:, 1]).sum() > len(detections) * len(trackers):
+        return None
+    rows = hi[:, 1].max() + 1
+
+    det_boxes, det_keys = grid_cells(lo[:len(detections)], hi[:len(detections)], rows)
+    trk_boxes, trk_keys = grid_cells(lo[len(detections):], hi[len(detections):], rows)
+    order = np.argsort(trk_keys, kind='stable')
+    trk_boxes, trk_keys = trk_boxes[order], trk_keys[order]
+
+    # join detection and tracker cells with the same key
+    first = np.searchsorted(trk_keys, det_keys, 'left')
+    counts = np.searchsorted(trk_keys, det_keys, 'right') - first
+    det_indices = np.repeat(det_boxes, counts)
+    trk_indices = trk_boxes[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+
+    # boxes sharing several cells are joined once per cell
+    pairs = np.unique(det_indices * len(trackers) + trk_indices)
+    det_indices, trk_indices = pairs // len(trackers), pairs % len(trackers)
+    ious = iou_boxes(detections[det_indices], trackers[trk_indices])
+    overlap = ious > 0
+    return det_indices[overlap], trk_indices[overlap], ious[overlap]
+
+
+def convert_bboxes_to_z(bboxes):
+    """
+    Takes bounding boxes in the form [[x1,y1,x2,y2],...] and returns z in the form
+      [[x,y,s,r],...] where x,y is the centre of the box and s is the scale/area and r is
       the aspect ratio
     """
-    w = bbox[2] - bbox[0]
-    h = bbox[3] - bbox[1]
-    x = bbox[0] + w / 2.
-    y = bbox[1] + h / 2.
-    s = w * h  # scale is just area
-    r = w / float(h)
-    return np.array([x, y, s, r]).reshape((4, 1))
+    w = bboxes[:, 2] - bboxes[:, 0]
+    h = bboxes[:, 3] - bboxes[:, 1]
+    z = np.empty((len(bboxes), 4))
+    z[:, 0] = bboxes[:, 0] + w / 2.
+    z[:, 1] = bboxes[:, 1] + h / 2.
+    z[:, 2] = w * h  # scale is just area
+    z[:, 3] = w / h
+    return z
 
 
-def convert_x_to_bbox(x, score=None):
+def convert_x_to_bboxes(x):
     """
-    Takes a bounding box in the centre form [x,y,s,r] and returns it in the form
-      [x1,y1,x2,y2] where x1,y1 is the top left and x2,y2 is the bottom right
+    Takes states in the centre form [[x,y,s,r,...],...] and returns bounding boxes in the form
+      [[x1,y1,x2,y2],...] where x1,y1 is the top left and x2,y2 is the bottom right
     """
-    w = np.sqrt(x[2] * x[3])
-    h = x[2] / w
-    if (score == None):
-        return np.array([x[0] - w / 2., x[1] - h / 2., x[0] + w / 2., x[1] + h / 2.]).reshape((1, 4))
-    else:
-        return np.array([x[0] - w / 2., x[1] - h / 2., x[0] + w / 2., x[1] + h / 2., score]).reshape((1, 5))
+    w = np.sqrt(x[:, 2] * x[:, 3])
+    h = x[:, 2] / w
+    bboxes = np.empty((len(x), 4))
+    bboxes[:, 0] = x[:, 0] - w / 2.
+    bboxes[:, 1] = x[:, 1] - h / 2.
+    bboxes[:, 2] = x[:, 0] + w / 2.
+    bboxes[:, 3] = x[:, 1] + h / 2.
+    return bboxes
 
 
-class KalmanBoxTracker(object):
+class KalmanBoxBatch(object):
     """
-    This class represents the internel state of individual tracked objects observed as bbox.
+    This class keeps the constant velocity Kalman filters of all tracked objects as struct-of-arrays.
+    Row i of the state array and of the covariance stack belongs to the i-th live track, so predict
+    and update run as single vectorized operations over all tracks.
     """
-    count = 0
+    dim_x = 7
+    dim_z = 4
 
-    def __init__(self, bbox, class_id, class_buffer_size=10):
+    def __init__(self, capacity=64):
         """
-        Initialises a tracker using initial bounding box.
+        Initialises empty state storage for up to capacity tracks, it grows when needed.
         """
-        # define constant velocity model
-        self.kf = KalmanFilter(dim_x=7, dim_z=4)
-        self.kf.F = np.array(
+        self.F = np.array(
             [[1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1], [0, 0, 0, 1, 0, 0, 0],
-             [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]])
-        self.kf.H = np.array(
-            [[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]])
+             [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]], dtype=np.float64)
+        self.H = np.array(
+            [[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0], [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]],
+            dtype=np.float64)
+
+        self.R = np.eye(self.dim_z)
+        self.R[2:, 2:] *= 10.
+        self.P0 = np.eye(self.dim_x)
+        self.P0[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
+        self.P0 *= 10.
+        self.Q = np.eye(self.dim_x)
+        self.Q[-1, -1] *= 0.01
+        self.Q[4:, 4:] *= 0.01
+        self._I = np.eye(self.dim_x)
+
+        self._x = np.zeros((capacity, self.dim_x))
+        self._P = np.zeros((capacity, self.dim_x, self.dim_x))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def x(self):
+        """
+        Returns the (T, 7) view of the states of live tracks.
+        """
+        return self._x[:self.count]
+
+    @property
+    def P(self):
+        """
+        Returns the (T, 7, 7) view of the covariances of live tracks.
+        """
+        return self._P[:self.count]
+
+    def _reserve(self, size):
+        if size <= len(self._x):
+            return
+        capacity = max(size, 2 * len(self._x))
+        x = np.zeros((capacity, self.dim_x))
+        P = np.zeros((capacity, self.dim_x, self.dim_x))
+        x[:self.count] = self.x
+        P[:self.count] = self.P
+        self._x, self._P = x, P
+
+    def add(self, bboxes):
+        """
+        Appends tracks initialised using bounding boxes in the form [[x1,y1,x2,y2],...]
+        """
+        n = len(bboxes)
+        if n == 0:
+            return
+        self._reserve(self.count + n)
+        new = slice(self.count, self.count + n)
+        self._x[new] = 0.
+        self._x[new, :4] = convert_bboxes_to_z(bboxes)
+        self._P[new] = self.P0
+        self.count += n
 
-        self.kf.R[2:, 2:] *= 10.
-        self.kf.P[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
-        self.kf.P *= 10.
-        self.kf.Q[-1, -1] *= 0.01
-        self.kf.Q[4:, 4:] *= 0.01
+    def compact(self, keep):
+        """
+        Removes tracks where keep is False and moves the remaining ones to the front preserving their order.
+        """
+        keep = np.flatnonzero(keep)
+        n = len(keep)
+        self._x[:n] = self._x[keep]
+        self._P[:n] = self._P[keep]
+        self.count = n
 
-        self.kf.x[:4] = convert_bbox_to_z(bbox)
+    def predict(self):
+        """
+        Advances all states and returns the predicted bounding box estimates.
+        """
+        x, P = self.x, self.P
+        x[(x[:, 6] + x[:, 2]) <= 0, 6] *= 0.0
+        x[:] = x @ self.F.T
+        P[:] = self.F @ P @ self.F.T + self.Q
+        return convert_x_to_bboxes(x)
+
+    def update(self, indices, bboxes):
+        """
+        Updates the states of the tracks at indices with observed bounding boxes.
+        """
+        if len(indices) == 0:
+            return
+        z = convert_bboxes_to_z(bboxes)
+        x = self._x[indices]
+        P = self._P[indices]
+
+        y = z - x @ self.H.T
+        PHT = P @ self.H.T
+        S = self.H @ PHT + self.R
+        K = PHT @ np.linalg.inv(S)
+        x += (K @ y[:, :, np.newaxis])[:, :, 0]
+
+        # P = (I-KH)P(I-KH)' + KRK' is more numerically stable than P = (I-KH)P
+        I_KH = self._I - K @ self.H
+        P = I_KH @ P @ I_KH.transpose(0, 2, 1) + K @ self.R @ K.transpose(0, 2, 1)
+
+        self._x[indices] = x
+        self._P[indices] = P
+
+    def get_state(self):
+        """
+        Returns the current bounding box estimates.
+        """
+        return convert_x_to_bboxes(self.x)
+
+
+class KalmanBoxTracker(object):
+    """
+    This class represents the internel state of individual tracked objects observed as bbox.
+    The filter state itself is a row of the KalmanBoxBatch owned by Sort.
+    """
+    count = itertools.count()  # next() on it is atomic, so trackers of different sources may run in threads
+
+    def __init__(self, class_id, class_buffer_size=10):
+        """
+        Initialises a tracker using initial class id.
+        """
         self.buff_size = class_buffer_size
         self.class_id = deque([int(class_id)])
         self.time_since_update = 0
-        self.id = KalmanBoxTracker.count
-        KalmanBoxTracker.count += 1
-        self.history = []
+        self.id = next(KalmanBoxTracker.count)
         self.hits = 0
         self.hit_streak = 0
         self.age = 0
 
-    def update(self, bbox, class_id):
+    def update(self, class_id):
         """
-        Updates the state vector with observed bbox.
+        Registers the observation of the tracked object.
         """
         self.time_since_update = 0
-        self.history = []
         self.hits += 1
         self.hit_streak += 1
-        self.kf.update(convert_bbox_to_z(bbox))
         if len(self.class_id) >= self.buff_size:
             self.class_id.popleft()
         self.class_id.append(int(class_id))
 
     def predict(self):
         """
-        Advances the state vector and returns the predicted bounding box estimate.
+        Advances the age of the tracked object.
         """
-        if ((self.kf.x[6] + self.kf.x[2]) <= 0):
-            self.kf.x[6] *= 0.0
-        self.kf.predict()
         self.age += 1
         if (self.time_since_update > 0):
             self.hit_streak = 0
         self.time_since_update += 1
-        self.history.append(convert_x_to_bbox(self.kf.x))
-        return self.history[-1]
-
-    def get_state(self):
-        """
-        Returns the current bounding box estimate.
-        """
-        return convert_x_to_bbox(self.kf.x)
 
 
 def associate_detections_to_trackers(detections, trackers, iou_threshold=0.1):
@@ -142,36 +306,95 @@ def associate_detections_to_trackers(detections, trackers, iou_threshold=0.1):
     """
     if (len(trackers) == 0) or (len(detections) == 0):
         return np.empty((0, 2), dtype=int), np.arange(len(detections)), np.empty((0, 5), dtype=int)
-    iou_matrix = np.zeros((len(detections), len(trackers)), dtype=np.float32)
+    # with more detections than trackers the dense solver leaves some detections unassigned and lists them
+    # before the rejected ones, which ones depends on its tie breaking, so new trackers would get other ids,
+    # and a threshold of 0 accepts pairs without overlap, which are not in the gate graph
+    if (iou_threshold > 0 and len(detections) <= len(trackers)
+            and len(detections) * len(trackers) >= GATING_MIN_PAIRS):
+        pairs = overlapping_pairs(detections, trackers)
+        if pairs is not None:
+            return associate_gated(len(detections), len(trackers), *pairs, iou_threshold)
+    iou_matrix = iou_batch(detections, trackers)
 
-    for d, det in enumerate(detections):
-        for t, trk in enumerate(trackers):
-            iou_matrix[d, t] = iou(det, trk)
     matched_indices = np.asarray(linear_sum_assignment(-iou_matrix))
     matched_indices = matched_indices.transpose()
-    unmatched_detections = []
-    for d, det in enumerate(detections):
-        if (d not in matched_indices[:, 0]):
-            unmatched_detections.append(d)
-    unmatched_trackers = []
-    for t, trk in enumerate(trackers):
-        if (t not in matched_indices[:, 1]):
-            unmatched_trackers.append(t)
 
     # filter out matched with low IOU
-    matches = []
-    for m in matched_indices:
-        if (iou_matrix[m[0], m[1]] < iou_threshold):
-            unmatched_detections.append(m[0])
-            unmatched_trackers.append(m[1])
-        else:
-            matches.append(m.reshape(1, 2))
-    if (len(matches) == 0):
-        matches = np.empty((0, 2), dtype=int)
-    else:
-        matches = np.concatenate(matches, axis=0)
+    low_iou = iou_matrix[matched_indices[:, 0], matched_indices[:, 1]] < iou_threshold
+    matches = matched_indices[~low_iou]
+
+    unmatched_detections = np.ones(len(detections), dtype=bool)
+    unmatched_detections[matched_indices[:, 0]] = False
+    unmatched_trackers = np.ones(len(trackers), dtype=bool)
+    unmatched_trackers[matched_indices[:, 1]] = False
+    # rejected pairs go last to keep the order in which new trackers are created
+    unmatched_detections = np.concatenate((np.flatnonzero(unmatched_detections), matched_indices[low_iou, 0]))
+    unmatched_trackers = np.concatenate((np.flatnonzero(unmatched_trackers), matched_indices[low_iou, 1]))
+
+    return matches, unmatched_detections, unmatched_trackers
+
+
+def group_by_component(labels, components_count):
+    """
+    Sorts nodes by the component they belong to.
+    Returns the sorted nodes, the offset of every component in them and the index of every node in its component.
+    """
+    order = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels, minlength=components_count)
+    offsets = np.cumsum(sizes) - sizes
+    local = np.empty(len(labels), dtype=np.int64)
+    local[order] = np.arange(len(labels)) - offsets[labels[order]]
+    return order, offsets, sizes, local
+
+
+def associate_gated(detections_count, trackers_count, det_indices, trk_indices, ious, iou_threshold):
+    """
+    Assigns detections to trackers given only the pairs that overlap at all.
+    Pairs without overlap add nothing to the total IOU, so the assignment is solved independently
+    on every connected component of the overlap graph, matches below the threshold are rejected afterwards
+    like in the dense solution, since a pair below it may still change which pairs are picked.
+    Unmatched indices are returned in ascending order, which is the order of the dense solution
+    as long as there are no more detections than trackers.
+    """
+    graph = coo_matrix((np.ones(len(ious)), (det_indices, detections_count + trk_indices)),
+                       shape=(detections_count + trackers_count,) * 2)
+    components_count, labels = connected_components(graph, directed=False)
+    det_order, det_offsets, det_sizes, det_local = group_by_component(labels[:detections_count], components_count)
+    trk_order, trk_offsets, trk_sizes, trk_local = group_by_component(labels[detections_count:], components_count)
 
-    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+    # a component of one detection and one tracker is a single pair matched as it is
+    components = labels[det_indices]
+    single = (det_sizes[components] == 1) & (trk_sizes[components] == 1)
+    accepted = single & (ious >= iou_threshold)
+    matched_dets = [det_indices[accepted]]
+    matched_trks = [trk_indices[accepted]]
+
+    order = np.argsort(components[~single], kind='stable')
+    components = components[~single][order]
+    rows = det_local[det_indices[~single][order]]
+    columns = trk_local[trk_indices[~single][order]]
+    ious = ious[~single][order]
+    bounds = np.flatnonzero(np.diff(components)) + 1
+    for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(components)]):
+        if start == end:
+            continue
+        component = components[start]
+        iou_matrix = np.zeros((det_sizes[component], trk_sizes[component]), dtype=np.float32)
+        iou_matrix[rows[start:end], columns[start:end]] = ious[start:end]
+        assigned_rows, assigned_columns = linear_sum_assignment(-iou_matrix)
+        # a row may still be left with a pair outside of the graph
+        assigned_ious = iou_matrix[assigned_rows, assigned_columns]
+        accepted = (assigned_ious > 0) & (assigned_ious >= iou_threshold)
+        matched_dets.append(det_order[det_offsets[component] + assigned_rows[accepted]])
+        matched_trks.append(trk_order[trk_offsets[component] + assigned_columns[accepted]])
+
+    matches = np.stack((np.concatenate(matched_dets), np.concatenate(matched_trks)), axis=1)
+    matches = matches[np.argsort(matches[:, 0], kind='stable')]
+    unmatched_detections = np.ones(detections_count, dtype=bool)
+    unmatched_detections[matches[:, 0]] = False
+    unmatched_trackers = np.ones(trackers_count, dtype=bool)
+    unmatched_trackers[matches[:, 1]] = False
+    return matches, np.flatnonzero(unmatched_detections), np.flatnonzero(unmatched_trackers)
 
 
 class Sort(object):
@@ -183,12 +406,51 @@ class Sort(object):
         self.max_age = max_age
         self.min_hits = min_hits
         self.trackers = []
+        self.kf = KalmanBoxBatch()
         self.frame_count = 0
 
-    def update(self, dets, class_buffer_size):
+    def _compact(self, keep):
+        """
+        Drops trackers where keep is False together with their filter states.
+        """
+        self.trackers = [trk for trk, k in zip(self.trackers, keep) if k]
+        self.kf.compact(keep)
+
+    def _reported(self):
+        """
+        Returns indices of trackers to report, updated on the last frame and confirmed by enough hits.
+        """
+        return [i for i in reversed(range(len(self.trackers)))
+                if (self.trackers[i].time_since_update < 1)
+                and (self.trackers[i].hit_streak >= self.min_hits or self.frame_count <= self.min_hits)]
+
+    def _track_row(self, state, i):
+        """
+        Returns the output row [x1,y1,x2,y2,id,class_id] of the i-th tracker.
+        """
+        trk = self.trackers[i]
+        class_id = int(Counter(trk.class_id).most_common(1)[0][0])
+        return np.concatenate((state, [trk.id], [class_id])).reshape(1, -1)
+
+    def predict(self):
+        """
+        Advances all trackers by one frame without detections, e.g. a frame skipped by the detector.
+        Unlike update the frame does not count as a miss towards max_age and hit_streak.
+        Returns predicted boxes of the trackers reported by the last update in the same format.
+        """
+        if len(self.trackers) == 0:
+            return np.empty((0, 5))
+        states = self.kf.predict()
+        ret = [self._track_row(states[i], i) for i in self._reported() if np.all(np.isfinite(states[i]))]
+        if (len(ret) > 0):
+            return np.concatenate(ret)
+        return np.empty((0, 5))
+
+    def update(self, dets, class_buffer_size, return_indices=False):
         """
         Params:
           dets - a numpy array of detections in the format [[x,y,w,h,score],[x,y,w,h,score],...]
+          return_indices - also return the index of the detection each returned track was associated with
         Requires: this method must be called once for each frame even with empty detections.
         Returns the a similar array, where the last column is the object ID.
         NOTE: The number of objects returned may differ from the number of detections provided.
@@ -196,43 +458,43 @@ class Sort(object):
 
         # prevent "too many indices for array" error
         if len(dets) == 0:
+            if return_indices:
+                return np.empty((0, 5)), np.empty(0, dtype=int)
             return np.empty((0, 5))
 
         self.frame_count += 1
         # get predicted locations from existing trackers.
-        trks = np.zeros((len(self.trackers), 5))
-        to_del = []
-        ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict()[0]
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-            if (np.any(np.isnan(pos))):
-                to_del.append(t)
-        trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
-        for t in reversed(to_del):
-            self.trackers.pop(t)
+        trks = self.kf.predict()
+        for trk in self.trackers:
+            trk.predict()
+        valid = np.all(np.isfinite(trks), axis=1)
+        if not np.all(valid):
+            self._compact(valid)
+            trks = trks[valid]
         matched, unmatched_dets, unmatched_trks = associate_detections_to_trackers(dets, trks)
 
         # update matched trackers with assigned detections
-        for t, trk in enumerate(self.trackers):
-            if (t not in unmatched_trks):
-                d = matched[np.where(matched[:, 1] == t)[0], 0]
-                trk.update(dets[d, :-1][0], dets[d, 5])
+        self.kf.update(matched[:, 1], dets[matched[:, 0], :4])
+        for d, t in matched:
+            self.trackers[t].update(dets[d, 5])
 
         # create and initialise new trackers for unmatched detections
+        self.kf.add(dets[unmatched_dets, :4])
         for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :], dets[i, 5], class_buffer_size)
-            self.trackers.append(trk)
-        i = len(self.trackers)
-        for trk in reversed(self.trackers):
-            d = trk.get_state()[0]
-            if ((trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits)):
-                class_id = int(Counter(trk.class_id).most_common(1)[0][0])
-                ret.append(np.concatenate((d, [trk.id], [class_id])).reshape(1, -1))  # +1 as MOT benchmark requires positive
-            i -= 1
-            # remove dead tracklet
-            if (trk.time_since_update > self.max_age):
-                self.trackers.pop(i)
-        if (len(ret) > 0):
-            return np.concatenate(ret)
-        return np.empty((0, 5))
\ No newline at end of file
+            self.trackers.append(KalmanBoxTracker(dets[i, 5], class_buffer_size))
+
+        # detection each tracker was updated or created with on this frame
+        det_indices = np.full(len(self.trackers), -1, dtype=int)
+        det_indices[matched[:, 1]] = matched[:, 0]
+        det_indices[len(self.trackers) - len(unmatched_dets):] = unmatched_dets
+
+        states = self.kf.get_state()
+        reported = self._reported()
+        ret = [self._track_row(states[i], i) for i in reported]
+        ret_indices = det_indices[reported]
+        # remove dead tracklets
+        self._compact([trk.time_since_update <= self.max_age for trk in self.trackers])
+        ret = np.concatenate(ret) if len(ret) > 0 else np.empty((0, 5))
+        if return_indices:
+            return ret, ret_indices
+        return ret
\ No newline at end of file
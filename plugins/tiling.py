@@ -0,0 +1,71 @@
+import numpy as np
+from .detection import batched_nms, filter_batch
+from .mmdet_backend import infer
+
+
+def tile_starts(length, tile_length, overlap):
+    """ Returns starts of tiles covering the length, the last tile is aligned to the end """
+    if tile_length >= length:
+        return [0]
+    stride = max(tile_length - overlap, 1)
+    starts = list(range(0, length - tile_length + 1, stride))
+    if starts[-1] + tile_length < length:
+        starts.append(length - tile_length)
+    return starts
+
+
+def tile_offsets(height, width, tile_size, overlap):
+    """
+    Splits the frame into overlapping square tiles, tiles of a frame smaller than tile_size are clipped.
+    Returns (x, y) offsets of the tiles and (height, width) of a tile.
+    """
+    xs = tile_starts(width, tile_size, overlap)
+    ys = tile_starts(height, tile_size, overlap)
+    offsets = np.array([(x, y) for y in ys for x in xs], dtype=np.float32)
+    return offsets, (min(tile_size, height), min(tile_size, width))
+
+
+def preprocess_tiles(preprocessor, tile_preprocessor, frames, tile_size, overlap, full_frame):
+    """
+    Preprocesses the tiles of all frames as one batch with tile_preprocessor, which keeps their native scale,
+    and, for the full-frame pass, the frames themselves with the resizing preprocessor.
+    Returns the tile inputs, tile offsets and the full-frame inputs or None.
+    """
+    height, width = frames[0].shape[:2]
+    offsets, (tile_height, tile_width) = tile_offsets(height, width, tile_size, overlap)
+    tiles = [frame[int(y):int(y) + tile_height, int(x):int(x) + tile_width] for frame in frames for x, y in offsets]
+    return tile_preprocessor(tiles), offsets, preprocessor(frames) if full_frame else None
+
+
+def detect_tiles(model, batch_ids, inputs, threshold, nms, classes=None, class_thresholds=None, max_detections=0):
+    """
+    Runs the detector on the tiles and the full frames of a batch, moves tile detections to frame
+    coordinates and merges detections of overlapping tiles with class-aware NMS.
+    Returns the boxes with their class ids by batch id of the frame.
+    """
+    tile_inputs, offsets, full_inputs = inputs
+    tile_ids = range(len(batch_ids) * len(offsets))
+    tiles = filter_batch(tile_ids, infer(model, *tile_inputs), threshold, nms, classes, class_thresholds)
+    frames = None
+    if full_inputs is not None:
+        frames = filter_batch(batch_ids, infer(model, *full_inputs), threshold, nms, classes, class_thresholds)
+
+    detections = {}
+    for i, batch_id in enumerate(batch_ids):
+        bboxes = []
+        class_ids = []
+        for tile_id, (x, y) in zip(tile_ids[i * len(offsets):(i + 1) * len(offsets)], offsets):
+            tile_bboxes, tile_class_ids = tiles[tile_id]
+            tile_bboxes = tile_bboxes.copy()
+            tile_bboxes[:, [0, 2]] += x
+            tile_bboxes[:, [1, 3]] += y
+            bboxes.append(tile_bboxes)
+            class_ids.append(tile_class_ids)
+        if frames is not None:
+            bboxes.append(frames[batch_id][0])
+            class_ids.append(frames[batch_id][1])
+        bboxes = np.vstack(bboxes)
+        class_ids = np.concatenate(class_ids)
+        keep = batched_nms(bboxes[:, :4], bboxes[:, 4], class_ids, nms, max_detections)
+        detections[batch_id] = (bboxes[keep], class_ids[keep])
+    return detections
@@ -0,0 +1,86 @@
+import csv
+import json
+import queue
+import threading
+import numpy as np
+
+MAGIC = b'TRKREC01'
+TRACK_DTYPE = np.dtype([
+    ('source_id', '<u4'),
+    ('frame_num', '<u4'),
+    ('track_id', '<u8'),
+    ('class_id', '<i4'),
+    ('confidence', '<f4'),
+    ('bbox', '<f4', (4,)),  # left, top, width, height
+])
+FORMATS = ('jsonl', 'csv', 'binary')
+
+
+class TrackWriter(object):
+    """
+    Writes batches of track rows to a file in a background thread.
+    Batches wait in a bounded queue, a batch that does not fit is dropped instead of blocking the caller.
+    """
+
+    def __init__(self, path, fmt='jsonl', queue_size=8):
+        if fmt not in FORMATS:
+            raise ValueError("unknown track export format %s" % fmt)
+        self.fmt = fmt
+        self.file = open(path, 'wb' if fmt == 'binary' else 'w', newline='' if fmt == 'csv' else None)
+        if fmt == 'binary':
+            self.file.write(MAGIC)
+        elif fmt == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(['source_id', 'frame_num', 'track_id', 'class_id', 'confidence',
+                               'left', 'top', 'width', 'height'])
+        self.written = 0
+        self.dropped = 0
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, name="track-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, rows):
+        """ Hands over the list of row tuples of TRACK_DTYPE without waiting, returns False if it is dropped """
+        try:
+            self.batches.put_nowait(rows)
+            return True
+        except queue.Full:
+            self.dropped += len(rows)
+            return False
+
+    def close(self, rows=None):
+        """ Writes the last rows and everything queued, then closes the file """
+        if rows:
+            self.batches.put(rows)
+        self.batches.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def run(self):
+        while True:
+            rows = self.batches.get()
+            if rows is None:
+                break
+            self.write(np.array(rows, dtype=TRACK_DTYPE))
+            # readers of the file see every batch as soon as it is written
+            self.file.flush()
+            self.written += len(rows)
+
+    def write(self, batch):
+        if self.fmt == 'binary':
+            self.file.write(batch.tobytes())
+            return
+
+        columns = [batch['source_id'].tolist(), batch['frame_num'].tolist(), batch['track_id'].tolist(),
+                   batch['class_id'].tolist(), np.round(batch['confidence'].astype(np.float64), 4).tolist()]
+        columns += np.round(batch['bbox'].astype(np.float64), 2).T.tolist()
+        if self.fmt == 'csv':
+            self.csv.writerows(zip(*columns))
+            return
+        lines = []
+        for source_id, frame_num, track_id, class_id, confidence, left, top, width, height in zip(*columns):
+            lines.append(json.dumps({"source_id": source_id, "frame_num": frame_num, "track_id": track_id,
+                                     "class_id": class_id, "confidence": confidence,
+                                     "bbox": [left, top, width, height]}))
+        self.file.write('\n'.join(lines) + '\n')
+
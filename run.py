@@ -1,22 +1,36 @@
 import gi
 import sys
+import importlib
+import json
+import math
+import time
 import argparse
 
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst, GObject, GLib
 from common.bus_call import bus_call
-from plugins import gst_mmdet
-from plugins import gst_sort
-from plugins import meta_drawer
+from common.latency import LatencyTracer
+from common.metrics import REGISTRY
+import common.is_aarch_64
+import pyds
 
 # Standard GStreamer initialization
 GObject.threads_init()
 Gst.init(None)
 net_input_size = (400, 400)
-
-
-def uridecodebin_newpad(uridecodebin, uridecodebin_src_pad, sink_pad):
-    pipeline, sink_pad = sink_pad
+# Python elements, a module registers its element when it is imported
+PLUGIN_MODULES = {
+    "mmdet": "plugins.gst_mmdet",
+    "detreplay": "plugins.gst_detreplay",
+    "gstsort": "plugins.gst_sort",
+    "trackexport": "plugins.gst_track_export",
+    "analytics": "plugins.gst_analytics",
+    "metadrawer": "plugins.meta_drawer",
+}
+
+
+def uridecodebin_newpad(uridecodebin, uridecodebin_src_pad, user_data):
+    pipeline, sink_pad, nvstreammux, frame_intervals = user_data
     print("\nIn uridecodebin_newpad ")
     new_pad_caps = uridecodebin_src_pad.get_current_caps()
     new_pad_struct = new_pad_caps.get_structure(0)
@@ -36,20 +50,60 @@ def uridecodebin_newpad(uridecodebin, uridecodebin_src_pad, sink_pad):
         else:
             sys.stderr.write(" Error: Decodebin did not pick nvidia decoder plugin.\n")
         print("\tThe pads are successfully linked.")
+        update_push_timeout(nvstreammux, new_pad_struct, frame_intervals, sink_pad.get_name())
 
     Gst.debug_bin_to_dot_file(pipeline, Gst.DebugGraphDetails.ALL, "pipeline")
 
 
-def decoder_added(uridecodebin, sub_bin, element, batch_size):
+def update_push_timeout(nvstreammux, caps_struct, frame_intervals, source):
+    """ Sets batched-push-timeout of nvstreammux to the frame interval of the slowest source """
+    success, num, den = caps_struct.get_fraction("framerate")
+    if not success or num == 0:
+        return
+    frame_intervals[source] = 1000000 * den // num  # in microseconds
+    timeout = max(frame_intervals.values())
+    print("\tSetting batched-push-timeout to %d us" % timeout)
+    nvstreammux.set_property('batched-push-timeout', timeout)
+
+
+def decoder_added(uridecodebin, sub_bin, element, num_extra_surfaces):
     try:
         nvv4l2decoder_type = Gst.ElementFactory.find("nvv4l2decoder").get_element_type()
         element_type = element.get_factory().get_element_type()
         if element_type == nvv4l2decoder_type:
-            element.set_property("num-extra-surfaces", batch_size - 4)
+            element.set_property("num-extra-surfaces", num_extra_surfaces)
     except:
         pass
 
 
+def read_sources(args):
+    """ Returns URIs given on the command line followed by the ones from the sources file """
+    uris = list(args["video"] or [])
+    if args["sources"]:
+        with open(args["sources"]) as sources_file:
+            uris += [line.strip() for line in sources_file if line.strip() and not line.startswith("#")]
+    return uris
+
+
+def count_frames(pad, info, frames_counter):
+    """
+    Counts frames of the batches passing the pad, the clock starts with the first batch,
+    so model loading and warm-up done while elements start are not counted
+    """
+    if frames_counter["start"] is None:
+        frames_counter["start"] = time.perf_counter()
+    batch_meta = pyds.gst_buffer_get_nvds_batch_meta(hash(info.get_buffer()))
+    if batch_meta is not None:
+        frames_counter["frames"] += batch_meta.num_frames_in_batch
+    return Gst.PadProbeReturn.OK
+
+
+def load_plugin(name):
+    """ Imports the module of a Python element, so pipelines pay only for the elements they use """
+    print("Loading %s \n" % name)
+    importlib.import_module(PLUGIN_MODULES[name])
+
+
 def enable_factory(name, enable=True):
     registry = Gst.Registry.get()
     if registry is None:
@@ -67,23 +121,74 @@ def enable_factory(name, enable=True):
 
 
 def main():
-    batch_size = 1
-    second = 1000000000  # sec in nanosec
-
     ap = argparse.ArgumentParser("Prepare and run tracking system on Deepstream/MMDetection")
-    ap.add_argument("-v", "--video", required=True, type=str, help="URL to video (e.g. file:///home/test.mp4)")
-    ap.add_argument("-d", "--detector", required=True, choices=['nvinfer', 'mmdetection'], help="Detector type")
+    ap.add_argument("-v", "--video", nargs="+", type=str, help="URLs to videos (e.g. file:///home/test.mp4)")
+    ap.add_argument("-s", "--sources", type=str, help="File with URLs to videos, one per line")
+    ap.add_argument("-d", "--detector", required=True, choices=['nvinfer', 'mmdetection', 'replay'],
+                    help="Detector type (replay - detections recorded by mmdetection with --record)")
     ap.add_argument("-t", "--tracker", required=True, choices=['nvtracker', 'sort'], help="Tracker type")
     ap.add_argument("-c", "--confidence", default=0.5, type=float, help="Detection confidence threshold (0, 1)")
     ap.add_argument("-n", "--nms", default=0.3, type=float, help="Non maximum suppression threshold (0, 1)")
+    ap.add_argument("-i", "--interval", default=1, type=int,
+                    help="Run the detector on every i-th frame, the tracker predicts the others")
     ap.add_argument("--height", default=504, type=int, help="Frame height for processing")
     ap.add_argument("--width", default=504, type=int, help="Frame width for processing")
-    ap.add_argument("--detector-config", required=True, type=str, help="Config file of detector")
+    ap.add_argument("--detector-config", type=str, help="Config file of detector")
     ap.add_argument("--detector-checkpoint", type=str, help="Checkpoint file of detector")
+    ap.add_argument("--async-depth", default=0, type=int,
+                    help="Frames in flight for asynchronous mmdetection inference (0 - synchronous)")
+    ap.add_argument("--device", default="cuda:0", type=str, help="Device of mmdetection inference (e.g. cuda:0, cpu)")
+    ap.add_argument("--backend", default="pytorch", choices=['pytorch', 'onnxruntime'],
+                    help="Backend of mmdetection inference, onnxruntime caches the exported model")
+    ap.add_argument("--detector-workers", default=0, type=int,
+                    help="Detector processes for mmdetection, frames are passed through shared memory (0 - in process)")
+    ap.add_argument("--tile-size", default=0, type=int,
+                    help="Detect on overlapping square tiles of the frame of this size (0 - whole frames), "
+                         "set --width/--height to the source resolution to keep small objects. Tiles are detected "
+                         "at native resolution, a size near the network input scale keeps the number of tiles low")
+    ap.add_argument("--tile-overlap", default=64, type=int, help="Overlap of neighbouring tiles in pixels")
+    ap.add_argument("--no-full-frame", action="store_true", help="Detect on tiles only, skipping the whole frame")
+    ap.add_argument("--motion-threshold", default=0., type=float,
+                    help="Skip detection on frames with a smaller ratio of changed pixels (0 - detect on every frame)")
+    ap.add_argument("--motion-max-skipped", default=30, type=int,
+                    help="Frames of a source skipped by the motion gate before detection is forced")
+    ap.add_argument("--motion-predict", action="store_true",
+                    help="Let the tracker predict frames skipped by the motion gate instead of reusing detections")
+    ap.add_argument("--warmup", default=1, type=int, help="Inferences on a blank frame before mmdetection starts")
+    ap.add_argument("--record", type=str, help="File to record mmdetection detections to")
+    ap.add_argument("--replay", type=str, help="File with recorded detections for the replay detector")
     ap.add_argument("--tracker-lib", type=str, help="Custom lib for nvtracker")
     ap.add_argument("--tracker-config", type=str, help="Config file of tracker")
+    ap.add_argument("--metrics-port", default=9400, type=int,
+                    help="Port of the HTTP endpoint with Prometheus metrics (0 - disabled)")
+    ap.add_argument("--sink", default="display", choices=['display', 'fakesink', 'file', 'none'],
+                    help="Where frames go: display, fakesink, encoded file or nowhere "
+                         "(none - the pipeline ends at the tracker without any rendering)")
+    ap.add_argument("-o", "--output", default="output.mp4", type=str, help="Output file of the file sink")
+    ap.add_argument("--no-draw", action="store_true", help="Do not draw boxes and labels on frames")
+    ap.add_argument("--export", type=str, help="File to export tracks to")
+    ap.add_argument("--export-format", default="jsonl", choices=['jsonl', 'csv', 'binary'],
+                    help="Format of the exported tracks")
+    ap.add_argument("--analytics", type=str,
+                    help="JSON file with gate lines and zone polygons to count tracks in: "
+                         '{"gates": {"name": [[x1, y1], [x2, y2]]}, "zones": {"name": [[x, y], ...]}}')
+    ap.add_argument("--anchor", default="bottom", choices=['bottom', 'center'],
+                    help="Point of a box counted by analytics: center of the bottom edge or center of the box")
+    ap.add_argument("--trace", type=str, help="File to write per-element latency statistics to on EOS")
 
     args = vars(ap.parse_args())
+    uris = read_sources(args)
+    if not uris:
+        ap.error("at least one video is required, use --video or --sources")
+    if args["detector"] == "replay" and not args["replay"]:
+        ap.error("--replay is required by the replay detector")
+    if args["detector"] != "replay" and not args["detector_config"]:
+        ap.error("--detector-config is required by the %s detector" % args["detector"])
+
+    # every source contributes one frame to a batch and a decoded surface may be held by any pooled batch
+    batch_size = len(uris)
+    buffer_pool_size = max(4, batch_size)
+    num_extra_surfaces = buffer_pool_size
 
     enable_factory("nvv4l2decoder", True)
     enable_factory("nvjpegdec", True)
@@ -94,10 +199,13 @@ def main():
     if not pipeline:
         sys.stderr.write("\tUnable to create Pipeline \n")
 
-    print("Creating uridecodebin \n")
-    uridecodebin = Gst.ElementFactory.make("uridecodebin", "uridecodebin")
-    if not uridecodebin:
-        sys.stderr.write("\tUnable to create uridecodebin \n")
+    uridecodebins = []
+    for i in range(batch_size):
+        print("Creating uridecodebin%d \n" % i)
+        uridecodebin = Gst.ElementFactory.make("uridecodebin", "uridecodebin%d" % i)
+        if not uridecodebin:
+            sys.stderr.write("\tUnable to create uridecodebin%d \n" % i)
+        uridecodebins.append(uridecodebin)
 
     print("Creating nvstreammux \n")
     nvstreammux = Gst.ElementFactory.make("nvstreammux", "nvstreammux")
@@ -114,20 +222,21 @@ def main():
     if not nvvideoconvert1:
         sys.stderr.write("\tUnable to create nvvideoconvert1 \n")
 
-    print("Creating nvvideoconvert2 \n")
-    nvvideoconvert2 = Gst.ElementFactory.make("nvvideoconvert", "nvvideoconvert2")
-    if not nvvideoconvert2:
-        sys.stderr.write("\tUnable to create nvvideoconvert2 \n")
-
     print("Creating detector \n")
     if args["detector"] == "nvinfer":
         detector = Gst.ElementFactory.make("nvinfer", "detector")
         if not detector:
             sys.stderr.write("\tUnable to create nvinfer \n")
     elif args["detector"] == "mmdetection":
+        load_plugin("mmdet")
         detector = Gst.ElementFactory.make("mmdet", "detector")
         if not detector:
             sys.stderr.write("\tUnable to create mmdet \n")
+    elif args["detector"] == "replay":
+        load_plugin("detreplay")
+        detector = Gst.ElementFactory.make("detreplay", "detector")
+        if not detector:
+            sys.stderr.write("\tUnable to create detreplay \n")
 
     print("Creating tracker \n")
     if args["tracker"] == "nvtracker":
@@ -135,91 +244,232 @@ def main():
         if not tracker:
             sys.stderr.write("\tUnable to create nvtracker \n")
     elif args["tracker"] == "sort":
+        load_plugin("gstsort")
         tracker = Gst.ElementFactory.make("gstsort", "tracker")
         if not tracker:
             sys.stderr.write("\tUnable to create gstsort \n")
 
-    print("Creating display_queue \n")
-    display_queue = Gst.ElementFactory.make("queue", "display_queue")
-    if not display_queue:
-        sys.stderr.write("\tUnable to create display_queue \n")
-
-    print("Creating metadrawer \n")
-    metadrawer = Gst.ElementFactory.make("metadrawer", "metadrawer")
-    if not metadrawer:
-        sys.stderr.write("\tUnable to create metadrawer \n")
-
-    print("Creating nveglglessink \n")
-    nveglglessink = Gst.ElementFactory.make("nveglglessink", "nveglglessink")
-    if not nveglglessink:
-        sys.stderr.write("\tUnable to create nveglglessink \n")
+    exporter = None
+    if args["export"]:
+        print("Creating trackexport \n")
+        load_plugin("trackexport")
+        exporter = Gst.ElementFactory.make("trackexport", "exporter")
+        if not exporter:
+            sys.stderr.write("\tUnable to create trackexport \n")
+
+    analytics = None
+    if args["analytics"]:
+        print("Creating analytics \n")
+        load_plugin("analytics")
+        analytics = Gst.ElementFactory.make("analytics", "analytics")
+        if not analytics:
+            sys.stderr.write("\tUnable to create analytics \n")
+
+    draw = args["sink"] != "none" and not args["no_draw"]
+    render = args["sink"] in ("display", "file")
+
+    if draw:
+        print("Creating nvvideoconvert2 \n")
+        nvvideoconvert2 = Gst.ElementFactory.make("nvvideoconvert", "nvvideoconvert2")
+        if not nvvideoconvert2:
+            sys.stderr.write("\tUnable to create nvvideoconvert2 \n")
+
+        print("Creating metadrawer \n")
+        load_plugin("metadrawer")
+        metadrawer = Gst.ElementFactory.make("metadrawer", "metadrawer")
+        if not metadrawer:
+            sys.stderr.write("\tUnable to create metadrawer \n")
+
+    tiler = None
+    if render and batch_size > 1:
+        print("Creating nvvideoconvert3 \n")
+        nvvideoconvert3 = Gst.ElementFactory.make("nvvideoconvert", "nvvideoconvert3")
+        if not nvvideoconvert3:
+            sys.stderr.write("\tUnable to create nvvideoconvert3 \n")
+
+        print("Creating nvmultistreamtiler \n")
+        tiler = Gst.ElementFactory.make("nvmultistreamtiler", "tiler")
+        if not tiler:
+            sys.stderr.write("\tUnable to create nvmultistreamtiler \n")
+
+    if args["sink"] == "display":
+        print("Creating display_queue \n")
+        display_queue = Gst.ElementFactory.make("queue", "display_queue")
+        if not display_queue:
+            sys.stderr.write("\tUnable to create display_queue \n")
+
+        print("Creating nveglglessink \n")
+        sink = Gst.ElementFactory.make("nveglglessink", "nveglglessink")
+        if not sink:
+            sys.stderr.write("\tUnable to create nveglglessink \n")
+        sink_elements = [display_queue, sink]
+    elif args["sink"] == "file":
+        print("Creating nvvideoconvert4 \n")
+        nvvideoconvert4 = Gst.ElementFactory.make("nvvideoconvert", "nvvideoconvert4")
+        if not nvvideoconvert4:
+            sys.stderr.write("\tUnable to create nvvideoconvert4 \n")
+
+        print("Creating encoder_caps \n")
+        encoder_caps = Gst.ElementFactory.make("capsfilter", "encoder_caps")
+        if not encoder_caps:
+            sys.stderr.write("\tUnable to create encoder_caps \n")
+
+        print("Creating nvv4l2h264enc \n")
+        encoder = Gst.ElementFactory.make("nvv4l2h264enc", "encoder")
+        if not encoder:
+            sys.stderr.write("\tUnable to create nvv4l2h264enc \n")
+
+        print("Creating h264parse \n")
+        h264parse = Gst.ElementFactory.make("h264parse", "h264parse")
+        if not h264parse:
+            sys.stderr.write("\tUnable to create h264parse \n")
+
+        print("Creating qtmux \n")
+        qtmux = Gst.ElementFactory.make("qtmux", "qtmux")
+        if not qtmux:
+            sys.stderr.write("\tUnable to create qtmux \n")
+
+        print("Creating filesink \n")
+        sink = Gst.ElementFactory.make("filesink", "filesink")
+        if not sink:
+            sys.stderr.write("\tUnable to create filesink \n")
+        sink_elements = [nvvideoconvert4, encoder_caps, encoder, h264parse, qtmux, sink]
+    else:
+        print("Creating fakesink \n")
+        sink = Gst.ElementFactory.make("fakesink", "fakesink")
+        if not sink:
+            sys.stderr.write("\tUnable to create fakesink \n")
+        sink_elements = [sink]
     # endregion
 
     # region Setting properties
     print("Setting properties \n")
-    uridecodebin.set_property('uri', args["video"])
+    for uridecodebin, uri in zip(uridecodebins, uris):
+        uridecodebin.set_property('uri', uri)
     nvstreammux.set_property('width', args["width"])
     nvstreammux.set_property('height', args["height"])
-    nvstreammux.set_property('buffer-pool-size', batch_size)
+    nvstreammux.set_property('buffer-pool-size', buffer_pool_size)
     nvstreammux.set_property('batch-size', batch_size)
-    nvstreammux.set_property('batched-push-timeout', 1000000)
+    nvstreammux.set_property('batched-push-timeout', 1000000)  # refined by the framerate of sources
     if args["detector"] == "nvinfer":
         detector.set_property('config-file-path', args["detector_config"])
+        detector.set_property('interval', args["interval"] - 1)  # nvinfer counts skipped batches
     elif args["detector"] == "mmdetection":
         detector.set_property('config', args["detector_config"])
         detector.set_property('checkpoint', args["detector_checkpoint"])
         detector.set_property('threshold', args["confidence"])
         detector.set_property('nms', args["nms"])
+        detector.set_property('async-depth', args["async_depth"])
+        detector.set_property('interval', args["interval"])
+        detector.set_property('record', args["record"])
+        detector.set_property('warmup', args["warmup"])
+        detector.set_property('device', args["device"])
+        detector.set_property('backend', args["backend"])
+        detector.set_property('workers', args["detector_workers"])
+        detector.set_property('tile-size', args["tile_size"])
+        detector.set_property('tile-overlap', args["tile_overlap"])
+        detector.set_property('tile-full-frame', not args["no_full_frame"])
+        detector.set_property('motion-threshold', args["motion_threshold"])
+        detector.set_property('motion-max-skipped', args["motion_max_skipped"])
+        detector.set_property('motion-reuse', not args["motion_predict"])
+    elif args["detector"] == "replay":
+        detector.set_property('record', args["replay"])
     if args["tracker"] == "nvtracker":
         tracker.set_property('tracker-width', args["width"])
         tracker.set_property('tracker-height', args["height"])
         tracker.set_property('ll-lib-file', args["tracker_lib"])
         tracker.set_property('ll-config-file', args["tracker_config"])
-    nveglglessink.set_property('sync', False)
+    if exporter is not None:
+        exporter.set_property('location', args["export"])
+        exporter.set_property('format', args["export_format"])
+    if analytics is not None:
+        with open(args["analytics"]) as f:
+            analytics_config = json.load(f)
+        analytics.set_property('gates', analytics_config.get("gates", {}))
+        analytics.set_property('zones', analytics_config.get("zones", {}))
+        analytics.set_property('anchor', args["anchor"])
+    if tiler is not None:
+        tiler_rows = int(math.sqrt(batch_size))
+        tiler_columns = int(math.ceil(batch_size / tiler_rows))
+        tiler.set_property('rows', tiler_rows)
+        tiler.set_property('columns', tiler_columns)
+        tiler.set_property('width', args["width"] * tiler_columns)
+        tiler.set_property('height', args["height"] * tiler_rows)
+    if args["sink"] == "file":
+        encoder_caps.set_property('caps', Gst.Caps.from_string("video/x-raw(memory:NVMM), format=I420"))
+        sink.set_property('location', args["output"])
+    # never wait for the clock, the pipeline runs as fast as its slowest element
+    sink.set_property('sync', False)
     # endregion
 
+    # the chain from the muxer to the sink, elements not needed by the chosen sink are left out
+    elements = [nvstreammux, nvvideoconvert0, detector, nvvideoconvert1, tracker]
+    if exporter is not None:
+        elements.append(exporter)
+    if analytics is not None:
+        elements.append(analytics)
+    if draw:
+        elements += [nvvideoconvert2, metadrawer]
+    if tiler is not None:
+        # frames of the batch are shown side by side
+        elements += [nvvideoconvert3, tiler]
+    elements += sink_elements
+
     print("Adding elements to the Pipeline \n")
-    pipeline.add(uridecodebin)
-    pipeline.add(nvstreammux)
-    pipeline.add(nvvideoconvert0)
-    pipeline.add(nvvideoconvert1)
-    pipeline.add(nvvideoconvert2)
-    pipeline.add(detector)
-    pipeline.add(tracker)
-    pipeline.add(metadrawer)
-    pipeline.add(display_queue)
-    pipeline.add(nveglglessink)
+    for uridecodebin in uridecodebins:
+        pipeline.add(uridecodebin)
+    for element in elements:
+        pipeline.add(element)
     # endregion
 
     # region Linking the elements
     print("Linking the elements \n")
-    mux_sink = nvstreammux.get_request_pad("sink_0")
-    uridecodebin.connect("pad-added", uridecodebin_newpad, (pipeline, mux_sink))
-    uridecodebin.connect("deep-element-added", decoder_added, batch_size)
-    nvstreammux.link(nvvideoconvert0)
-    nvvideoconvert0.link(detector)
-    detector.link(nvvideoconvert1)
-    nvvideoconvert1.link(tracker)
-    tracker.link(nvvideoconvert2)
-    nvvideoconvert2.link(metadrawer)
-    metadrawer.link(display_queue)
-    display_queue.link(nveglglessink)
+    frame_intervals = {}
+    for i, uridecodebin in enumerate(uridecodebins):
+        mux_sink = nvstreammux.get_request_pad("sink_%d" % i)
+        uridecodebin.connect("pad-added", uridecodebin_newpad, (pipeline, mux_sink, nvstreammux, frame_intervals))
+        uridecodebin.connect("deep-element-added", decoder_added, num_extra_surfaces)
+    for upstream, downstream in zip(elements, elements[1:]):
+        if not upstream.link(downstream):
+            sys.stderr.write("\tUnable to link %s to %s \n" % (upstream.get_name(), downstream.get_name()))
     # endregion
 
+    # every frame passes the tracker whichever sink is chosen, the tiler merges frames of a batch
+    frames_counter = {"frames": 0, "start": None}
+    tracker.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, count_frames, frames_counter)
+
+    tracer = None
+    if args["trace"]:
+        tracer = LatencyTracer()
+        tracer.trace(elements)
+
     # create an event loop and feed gstreamer bus mesages to it
     loop = GLib.MainLoop()
     bus = pipeline.get_bus()
     bus.add_signal_watch()
     bus.connect("message", bus_call, loop)
 
+    if args["metrics_port"]:
+        print("Serving metrics on port %d \n" % args["metrics_port"])
+        REGISTRY.serve(args["metrics_port"])
+
     # start play back and listen to events
     print("Starting pipeline \n")
-    print("Playing file %s \n" % args["video"])
+    for uri in uris:
+        print("Playing file %s \n" % uri)
     pipeline.set_state(Gst.State.PLAYING)
     try:
         loop.run()
     except:
         pass
+    start = frames_counter["start"]
+    wall_time = time.perf_counter() - start if start is not None else 0.
+    print("Processed %d frames in %.2f s, %.2f fps \n" %
+          (frames_counter["frames"], wall_time, frames_counter["frames"] / wall_time if wall_time > 0 else 0.))
+
+    if tracer is not None:
+        print("Writing latency trace to %s \n" % args["trace"])
+        tracer.write(args["trace"])
 
     print("Cleaning pipeline \n")
     Gst.debug_bin_to_dot_file(pipeline, Gst.DebugGraphDetails.ALL, "pipeline")
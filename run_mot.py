@@ -0,0 +1,100 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from plugins.sort import Sort, KalmanBoxTracker
+
+
+def load_detections(det_path, min_confidence):
+    """
+    Reads MOT detections "frame,id,left,top,width,height,confidence,..." and returns
+    the list of per-frame arrays [[x1,y1,x2,y2,score,class_id],...] indexed by frame - 1
+    """
+    rows = np.loadtxt(det_path, delimiter=',', ndmin=2)
+    if len(rows) == 0:
+        # an empty file is read as a (0, 1) array
+        return []
+    rows = rows[rows[:, 6] >= min_confidence]
+    frames_count = int(rows[:, 0].max()) if len(rows) else 0
+    rows = rows[np.argsort(rows[:, 0], kind='stable')]
+
+    dets = np.zeros((len(rows), 6))
+    dets[:, :2] = rows[:, 2:4]
+    dets[:, 2:4] = rows[:, 2:4] + rows[:, 4:6]
+    dets[:, 4] = rows[:, 6]
+    bounds = np.searchsorted(rows[:, 0], np.arange(1, frames_count + 2))
+    return [dets[bounds[i]:bounds[i + 1]] for i in range(frames_count)]
+
+
+def run_sequence(det_path, output_path, max_age, min_hits, min_confidence):
+    """ Tracks detections of a sequence, writes MOT results and returns timing statistics """
+    frames = load_detections(det_path, min_confidence)
+    # ids start from 1 in every sequence as MOT requires, a worker process runs one sequence at a time
+    KalmanBoxTracker.count = itertools.count()
+    sort = Sort(max_age=max_age, min_hits=min_hits)
+
+    latencies = np.zeros(len(frames))
+    results = []
+    for frame_index, dets in enumerate(frames):
+        start = time.perf_counter()
+        tracks = sort.update(dets, 5)
+        latencies[frame_index] = time.perf_counter() - start
+        for track in tracks:
+            results.append((frame_index + 1, track[4] + 1, track[0], track[1], track[2] - track[0], track[3] - track[1]))
+
+    with open(output_path, 'w') as out_file:
+        for row in results:
+            print('%d,%d,%.2f,%.2f,%.2f,%.2f,1,-1,-1,-1' % row, file=out_file)
+
+    total = latencies.sum()
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(frames) else (0., 0., 0.)
+    return {
+        "frames": len(frames),
+        "max_objects": max((len(dets) for dets in frames), default=0),
+        "fps": len(frames) / total if total > 0 else 0.,
+        "p50": p50,
+        "p95": p95,
+        "p99": p99
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser("Run SORT offline on MOTChallenge detections")
+    ap.add_argument("-s", "--seq-path", required=True, type=str, help="Path to MOT sequences (e.g. data/train)")
+    ap.add_argument("-p", "--pattern", default=os.path.join("*", "det", "det.txt"), type=str,
+                    help="Pattern of detection files relative to the sequences path")
+    ap.add_argument("-o", "--output", default="output", type=str, help="Directory for MOT results")
+    ap.add_argument("-w", "--workers", default=os.cpu_count(), type=int, help="Number of processes")
+    ap.add_argument("--max-age", default=10, type=int, help="Frames to keep a track alive without detections")
+    ap.add_argument("--min-hits", default=5, type=int, help="Detections needed before a track is reported")
+    ap.add_argument("-c", "--confidence", default=0., type=float, help="Detection confidence threshold")
+
+    args = vars(ap.parse_args())
+
+    det_paths = sorted(glob.glob(os.path.join(args["seq_path"], args["pattern"])))
+    if not det_paths:
+        sys.stderr.write("No detection files found in %s\n" % args["seq_path"])
+        return 1
+    os.makedirs(args["output"], exist_ok=True)
+    # sequence name is the directory above det/det.txt
+    names = [os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(path)))) for path in det_paths]
+    output_paths = [os.path.join(args["output"], "%s.txt" % name) for name in names]
+
+    with ProcessPoolExecutor(max_workers=args["workers"]) as executor:
+        stats = executor.map(run_sequence, det_paths, output_paths,
+                             itertools.repeat(args["max_age"]), itertools.repeat(args["min_hits"]),
+                             itertools.repeat(args["confidence"]))
+        print("%-24s %8s %8s %10s %9s %9s %9s" % ("sequence", "frames", "objects", "fps", "p50 ms", "p95 ms", "p99 ms"))
+        for name, stat in zip(names, stats):
+            print("%-24s %8d %8d %10.1f %9.3f %9.3f %9.3f" % (name, stat["frames"], stat["max_objects"], stat["fps"],
+                                                              stat["p50"], stat["p95"], stat["p99"]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())